@@ -0,0 +1,139 @@
+"""Generate masks listed in a job spec file in parallel.
+
+    python -m MaskImageGenerator.batch jobs.json -o output -w 8
+
+A JSON job spec is a list of jobs like below; name is the stem of the output file
+and defaults to the index of the job and the generator name.
+
+    [
+        {"generator": "RadialGradientMask", "params": {"height": 512, "width": 512}},
+        {"generator": "CircleMask", "params": {"radius": 80}, "name": "circle_80"}
+    ]
+
+A CSV job spec has generator and name columns, and a column for each parameter;
+the values are parsed as JSON if possible, and empty values are omitted.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .registry import create_image
+from .utils import make_path, output_image
+
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+
+def load_jobs(path):
+    if path.endswith('.csv'):
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+
+        jobs = []
+        for row in rows:
+            job = dict(generator=row.pop('generator'), name=row.pop('name', None) or None)
+            job['params'] = {k: parse_value(v) for k, v in row.items() if v not in (None, '')}
+            jobs.append(job)
+    else:
+        with open(path) as f:
+            jobs = json.load(f)
+
+    for i, job in enumerate(jobs):
+        if not job.get('name'):
+            job['name'] = f'{i:06d}_{job["generator"]}'
+
+    return jobs
+
+
+def output_path(job, output_dir):
+    """Return the path of the image of a job; the name must not contain path separators or '..',
+       so that the image is written into output_dir.
+    """
+    name = str(job['name'])
+    if any(sep in name for sep in (os.sep, os.altsep, '..') if sep):
+        raise ValueError(f'Invalid job name: {name!r}; it must not contain path separators or "..".')
+
+    return os.path.join(output_dir, f'{name}.png')
+
+
+def run_job(job, output_dir):
+    """Generate the image of a job and write it; return the bytes written.
+       The image is written into a temporary file first, so that a partial image is never left
+       to be skipped by resume.
+    """
+    path = output_path(job, output_dir)
+    img = create_image(job['generator'], job.get('params', {}))
+    stem = f'{job["name"]}.{os.getpid()}.tmp'
+    tmp = make_path(stem, '.png', output_dir, with_suffix=False)
+
+    try:
+        output_image(img, stem, output_dir, with_suffix=False)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    return os.path.getsize(path)
+
+
+def run_jobs(jobs, output_dir, workers=None, resume=True):
+    """Run jobs on a process pool and return the summary.
+        Args:
+            jobs (list): The jobs loaded by load_jobs.
+            output_dir (str): The directory into which the images are written.
+            workers (int): The number of worker processes; if None, the number of CPUs.
+            resume (bool): If True, the jobs whose output file already exists are skipped.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    todo = [job for job in jobs if not (resume and os.path.exists(output_path(job, output_dir)))]
+    summary = dict(total=len(jobs), skipped=len(jobs) - len(todo), done=0, failed=0, bytes=0)
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_job, job, output_dir): job for job in todo}
+
+        for future in as_completed(futures):
+            try:
+                summary['bytes'] += future.result()
+                summary['done'] += 1
+            except Exception as e:
+                summary['failed'] += 1
+                print(f'{futures[future]["name"]}: {e!r}', file=sys.stderr)
+
+    summary['seconds'] = time.perf_counter() - start
+    elapsed = max(summary['seconds'], 1e-9)
+    summary['masks_per_sec'] = summary['done'] / elapsed
+    summary['mb_per_sec'] = summary['bytes'] / 1024 ** 2 / elapsed
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate masks listed in a job spec file.')
+    parser.add_argument('spec', help='The job spec file; .json or .csv.')
+    parser.add_argument('-o', '--output-dir', default='.', help='The directory into which the images are written.')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='The number of worker processes.')
+    parser.add_argument('--no-resume', action='store_true', help='Regenerate the images which already exist.')
+    args = parser.parse_args(argv)
+
+    jobs = load_jobs(args.spec)
+    summary = run_jobs(jobs, args.output_dir, args.workers, not args.no_resume)
+
+    print(
+        f'{summary["done"]} done, {summary["skipped"]} skipped, {summary["failed"]} failed '
+        f'in {summary["seconds"]:.2f} s: {summary["masks_per_sec"]:.1f} masks/s, '
+        f'{summary["mb_per_sec"]:.2f} MB/s written'
+    )
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
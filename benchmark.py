@@ -0,0 +1,253 @@
+"""Measure the time and memory of every generator class.
+
+    python -m MaskImageGenerator.benchmark --sizes 256 1024 4096 8192 --json result.json
+    python -m MaskImageGenerator.benchmark --sizes 256 1024 --compare result.json
+    python -m MaskImageGenerator.benchmark --imports
+    python -m MaskImageGenerator.benchmark --sizes 4096 --workers 1 2 4 8 16 32
+
+Each case runs in a fresh process, so that the peak RSS is of the case only.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from .registry import get_generator
+from .utils import cv2
+
+
+DEFAULT_SIZES = (256, 1024, 4096, 8192)
+
+# The modules whose import times are measured; numpy and cv2 are for comparison.
+IMPORT_MODULES = ('radial_gradient_generator', 'linear_gradient_generator', 'compose', 'registry', 'numpy', 'cv2')
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, 'cv2' in sys.modules)
+"""
+
+
+def get_params(name, size, blur):
+    """Return the parameters of create_image of the generator for a size x size image;
+       None, if the generator has no blur but blur is True.
+    """
+    params = dict(height=size, width=size)
+
+    match name:
+        case 'LinearGradient':
+            params.update(start_color=(0, 0, 0), end_color=(255, 255, 255), is_horizontal=(True, False, True))
+        case 'RadialGradient':
+            params.update(inner_color=(255, 0, 0), outer_color=(0, 0, 255))
+        case 'Circles':
+            params.update(bg_color=(0, 0, 0), circlr_color=(255, 0, 0), radius=size // 5)
+        case 'CircleMask' | 'TransparentCircleMask':
+            params.update(radius=size // 5)
+        case 'Lines' | 'LineMask' | 'TransparentLineMask':
+            end = size - 1
+            params['coordinates'] = [
+                [(0, 0), (end, end)], [(0, size // 2), (end, size // 2)],
+                [(size // 2, 0), (size // 2, end)], [(0, end), (end, 0)]
+            ]
+            if name == 'Lines':
+                params.update(bg_color=(0, 0, 0), line_color=(255, 0, 0))
+
+    if name in ('Circles', 'CircleMask', 'TransparentCircleMask'):
+        params['gaussian_kernel'] = 51 if blur else None
+    elif name in ('Lines', 'LineMask', 'TransparentLineMask'):
+        params['gaussian_kernel'] = 31 if blur else None
+    elif blur:
+        return None
+
+    return params
+
+
+def run_case(name, size, blur, output, repeat):
+    """Run a case repeat times and return the result.
+    """
+    cls = get_generator(name)
+    params = get_params(name, size, blur)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        if output:
+            def func():
+                cls.output_image(**params, output_dir=output_dir)
+        else:
+            def func():
+                cls.create_image(**params)
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+
+    return dict(
+        generator=name,
+        size=size,
+        blur=blur,
+        output=output,
+        repeat=repeat,
+        seconds_min=min(times),
+        seconds_median=statistics.median(times),
+        megapixels_per_sec=size * size / 1e6 / min(times),
+        peak_bytes=peak,
+        max_rss_bytes=max_rss
+    )
+
+
+def run(names, sizes, repeat=3):
+    cases = [
+        (name, size, blur, output, repeat)
+        for size in sizes
+        for name in names
+        for blur in (False, True)
+        for output in (False, True)
+        if get_params(name, size, blur) is not None
+    ]
+
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+        futures = [executor.submit(run_case, *case) for case in cases]
+        for future in futures:
+            result = future.result()
+            print_row(result)
+            yield result
+
+
+def time_import(module, repeat=5):
+    """Import the module in fresh processes, and return the minimum seconds and whether cv2 was imported.
+    """
+    name = module if module in ('numpy', 'cv2') else f'{__package__}.{module}'
+    # The directory which contains this package.
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    times = []
+
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT.format(module=name)],
+            capture_output=True, text=True, check=True, env=env
+        ).stdout.split()
+        times.append(float(output[0]))
+
+    return dict(module=module, seconds_min=min(times), imports_cv2=output[1] == 'True')
+
+
+def time_workers(name, size, workers, repeat=3):
+    """Return the minimum seconds of create_image with blur, if the generator has it, for each number of workers.
+    """
+    cls = get_generator(name)
+    params = get_params(name, size, True) or get_params(name, size, False)
+    times = {}
+
+    for n in workers:
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cls.create_image(**params, workers=n)
+            runs.append(time.perf_counter() - start)
+        times[n] = min(runs)
+
+    return times
+
+
+def case_key(result):
+    return (result['generator'], result['size'], result['blur'], result['output'])
+
+
+HEADER = f'{"generator":<34}{"size":>6}{"blur":>6}{"file":>6}{"min s":>10}{"median s":>10}{"MP/s":>9}{"peak MB":>9}{"RSS MB":>9}'
+
+
+def print_row(result, baseline=None):
+    row = (
+        f'{result["generator"]:<34}{result["size"]:>6}{result["blur"]!s:>6}{result["output"]!s:>6}'
+        f'{result["seconds_min"]:>10.4f}{result["seconds_median"]:>10.4f}{result["megapixels_per_sec"]:>9.1f}'
+        f'{result["peak_bytes"] / 1024 ** 2:>9.1f}{result["max_rss_bytes"] / 1024 ** 2:>9.1f}'
+    )
+
+    if baseline is not None:
+        row += f'{baseline["seconds_min"] / result["seconds_min"]:>9.2f}x'
+
+    print(row, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the time and memory of the generator classes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='The heights and widths of images.')
+    parser.add_argument('--generators', nargs='+', default=None, help='The generator class names; all, if not specified.')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of runs timed in each case.')
+    parser.add_argument('--json', help='The file into which the results are written.')
+    parser.add_argument('--compare', help='A file of results written before; the speedups against it are printed.')
+    parser.add_argument('--imports', action='store_true', help='Measure the import times of the modules only.')
+    parser.add_argument('--workers', type=int, nargs='+', help='Measure the scaling over these numbers of threads only.')
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        print(f'{"module":<34}{"import ms":>10}{"cv2":>6}')
+        for module in IMPORT_MODULES:
+            result = time_import(module, args.repeat)
+            print(f'{module:<34}{result["seconds_min"] * 1e3:>10.1f}{result["imports_cv2"]!s:>6}')
+        return
+
+    from .registry import GENERATORS
+    names = args.generators or list(GENERATORS)
+
+    if args.workers:
+        print(f'{os.cpu_count()} CPUs')
+        print(f'{"generator":<34}{"size":>6}' + ''.join(f'{f"{n} s":>9}{"x":>7}' for n in args.workers))
+        for size in args.sizes:
+            for name in names:
+                times = time_workers(name, size, args.workers, args.repeat)
+                base = times[args.workers[0]]
+                print(f'{name:<34}{size:>6}' + ''.join(f'{t:>9.4f}{base / t:>7.2f}' for t in times.values()), flush=True)
+        return
+
+    print(HEADER)
+    results = list(run(names, args.sizes, args.repeat))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baselines = {case_key(r): r for r in json.load(f)['results']}
+
+        print(f'\nspeedup against {args.compare}')
+        print(HEADER + f'{"speedup":>10}')
+        for result in results:
+            if (baseline := baselines.get(case_key(result))) is not None:
+                print_row(result, baseline)
+
+    if args.json:
+        meta = dict(
+            date=datetime.now().isoformat(timespec='seconds'),
+            python=platform.python_version(),
+            numpy=np.__version__,
+            opencv=cv2.__version__,
+            platform=platform.platform(),
+            processor=platform.processor()
+        )
+        with open(args.json, 'w') as f:
+            json.dump(dict(meta=meta, results=results), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import hashlib
+import inspect
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# The parameters of create_image which change how an image is computed, but not the image.
+EXECUTION_PARAMS = ('workers', 'out')
+
+
+def normalize_params(generator_cls, params):
+    """Return the arguments of generator_cls.create_image, including default values,
+       converted into JSON values so that equal arguments always make the same key;
+       EXECUTION_PARAMS are excluded.
+    """
+    bound = inspect.signature(generator_cls.create_image).bind(**params)
+    bound.apply_defaults()
+
+    def convert(value):
+        # dtypes like numpy.uint8 are keyed by their names.
+        if isinstance(value, np.dtype) or isinstance(value, type) and issubclass(value, np.generic):
+            return np.dtype(value).name
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, (tuple, list)):
+            return [convert(v) for v in value]
+        return value
+
+    return {name: convert(value) for name, value in bound.arguments.items() if name not in EXECUTION_PARAMS}
+
+
+def make_key(generator_cls, params):
+    params = normalize_params(generator_cls, params)
+    text = json.dumps([generator_cls.__name__, params], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class MaskCache:
+    """A cache of the images created by create_image of the generator classes.
+       The images are held in memory up to max_bytes, evicting the least recently used ones;
+       if cache_dir is specified, they are also saved as .npy files keyed by the parameters.
+        Args:
+            max_bytes (int): The maximum bytes of the images held in memory; default is 256 MiB.
+            cache_dir (str): The directory of the .npy files; if None, the images are not saved.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self._images),
+            nbytes=self.nbytes
+        )
+
+    def get(self, generator_cls, **params):
+        """Return the read-only image which generator_cls.create_image(**params) creates;
+           if out is in params, the image is copied into it and out is returned.
+        """
+        out = params.pop('out', None)
+        key = make_key(generator_cls, params)
+        img = self._get(key, generator_cls, params)
+
+        if out is None:
+            return img
+
+        out[:] = img
+        return out
+
+    def _get(self, key, generator_cls, params):
+        with self._lock:
+            if (img := self._images.get(key)) is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return img
+
+        if (img := self._load(key)) is not None:
+            self.disk_hits += 1
+        else:
+            img = np.ascontiguousarray(generator_cls.create_image(**params))
+            self.misses += 1
+            self._save(key, img)
+
+        img.flags.writeable = False
+        self._put(key, img)
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+
+    def _put(self, key, img):
+        if img.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._images:
+                return
+
+            self._images[key] = img
+            self.nbytes += img.nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, old = self._images.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def _load(self, key):
+        if self.cache_dir is None or not os.path.exists(path := self._path(key)):
+            return None
+
+        return np.load(path)
+
+    def _save(self, key, img):
+        if self.cache_dir is None:
+            return
+
+        # Write into a temporary file first so that other processes never read a partial file.
+        tmp = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, img)
+        os.replace(tmp, self._path(key))
@@ -0,0 +1,346 @@
+"""Compose black and white masks lazily.
+
+    from compose import mask
+    from radial_gradient_generator import RadialGradientMask
+    from shapes.circle_generator import CircleMask
+
+    radial = mask(RadialGradientMask(4096, 4096))
+    circles = CircleMask(4096, 4096)
+    circle = mask(circles, draw=lambda img, offset: circles.create_circle(img, 500, offset=offset), kernel=51)
+    img = (radial * ~circle).maximum(circle.threshold(0.9)).evaluate()
+
+The operators only build an expression graph. evaluate computes it in chunks of rows which fit in the cache,
+so that no intermediate array of the whole image is created; the values are from 0 to 1 in float32
+while computed, and the sub-expressions which appear more than once are computed only once in each chunk.
+"""
+import numpy as np
+
+from .utils import expand_mask, output_image
+
+
+# The bytes of a float32 chunk of rows, which is small enough to stay in the cache.
+CHUNK_BYTES = 2 ** 18
+
+# The number of rows which a generator computes at once; larger than a chunk,
+# because shape masks draw and blur the rows around a strip too.
+TILE_ROWS = 256
+
+# The binary operations whose operands can be swapped.
+COMMUTATIVE = ('multiply', 'add', 'minimum', 'maximum')
+
+
+def key_value(value):
+    if isinstance(value, (int, float, str, bool, type(None))):
+        return value
+    return id(value)
+
+
+class Mask:
+    """A node of an expression graph of masks, whose values are from 0 to 1.
+       Create leaves with mask, and combine them with *, +, ~ (1 - mask),
+       minimum, maximum, clamp and threshold; numbers can be operands too.
+    """
+
+    def __init__(self, op, inputs=(), args=()):
+        self.op = op
+        self.inputs = tuple(inputs)
+        self.args = tuple(args)
+
+        sizes = {(node.height, node.width) for node in self.inputs if node.height is not None}
+        if len(sizes) > 1:
+            raise ValueError(f'The masks must have the same height and width: {sorted(sizes)}.')
+
+        self.height, self.width = sizes.pop() if sizes else (None, None)
+        self._key = None
+
+    @property
+    def key(self):
+        """The structure of the expression, which is the same for the same sub-expressions.
+        """
+        if self._key is None:
+            inputs = [node.key for node in self.inputs]
+            if self.op in COMMUTATIVE:
+                inputs.sort(key=repr)
+            self._key = (self.op, tuple(key_value(v) for v in self.args), tuple(inputs))
+
+        return self._key
+
+    def _apply(self, op, *operands, args=()):
+        inputs = [self] + [v if isinstance(v, Mask) else Mask('const', args=(float(v),)) for v in operands]
+        return Mask(op, inputs, args)
+
+    def __mul__(self, other):
+        return self._apply('multiply', other)
+
+    __rmul__ = __mul__
+
+    def __add__(self, other):
+        return self._apply('add', other)
+
+    __radd__ = __add__
+
+    def __invert__(self):
+        return self._apply('invert')
+
+    def minimum(self, other):
+        return self._apply('minimum', other)
+
+    def maximum(self, other):
+        return self._apply('maximum', other)
+
+    def clamp(self, low=0, high=1):
+        return self._apply('clamp', args=(low, high))
+
+    def threshold(self, value=0.5):
+        """Return 1 where the mask is value or more, otherwise 0.
+        """
+        return self._apply('threshold', args=(value,))
+
+    def compute(self, start, stop, values, out):
+        """Compute the rows from start to stop into out from the values of the inputs.
+        """
+        match self.op:
+            case 'multiply' | 'add' | 'minimum' | 'maximum':
+                getattr(np, self.op)(*values, out=out)
+            case 'invert':
+                np.subtract(1, values[0], out=out)
+            case 'clamp':
+                np.clip(values[0], *self.args, out=out)
+            case 'threshold':
+                np.greater_equal(values[0], self.args[0], out=out)
+
+    def _plan(self):
+        """Return the unique nodes in the order of evaluation, the indices of their inputs,
+           and the index of the node which uses each node last.
+        """
+        order = []
+        indices = {}
+
+        def visit(node):
+            if (index := indices.get(node.key)) is None:
+                inputs = [visit(child) for child in node.inputs]
+                index = indices[node.key] = len(order)
+                order.append((node, inputs))
+            return index
+
+        visit(self)
+        last_use = {}
+        for i, (_, inputs) in enumerate(order):
+            for j in inputs:
+                last_use[j] = i
+
+        return order, last_use
+
+    def evaluate_rows(self, start, stop, out, chunk_rows=None):
+        """Evaluate the rows from start to stop into out, which is uint8 from 0 to 255 or float from 0 to 1.
+        """
+        if self.height is None:
+            raise ValueError('The expression has no masks.')
+
+        if chunk_rows is None:
+            chunk_rows = max(1, CHUNK_BYTES // (self.width * 4))
+
+        order, last_use = self._plan()
+        root = len(order) - 1
+        buffers = [None] * len(order)
+        pool = []
+
+        for chunk_start in range(start, stop, chunk_rows):
+            chunk_stop = min(chunk_start + chunk_rows, stop)
+            values = [None] * len(order)
+
+            for i, (node, inputs) in enumerate(order):
+                if node.op == 'const':
+                    values[i] = node.args[0]
+                    continue
+
+                # The buffers whose values are no longer used are reused by the later nodes.
+                if buffers[i] is None:
+                    buffers[i] = pool.pop() if pool else np.empty((chunk_rows, self.width), dtype=np.float32)
+
+                values[i] = buffers[i][:chunk_stop - chunk_start]
+                node.compute(chunk_start, chunk_stop, [values[j] for j in inputs], values[i])
+
+                for j in set(inputs):
+                    if last_use[j] == i and buffers[j] is not None:
+                        pool.append(buffers[j])
+                        buffers[j] = None
+
+            rows = out[chunk_start - start:chunk_stop - start]
+
+            if out.dtype == np.uint8:
+                # Rounded, so that a mask which is not changed is the same as the one of the generator.
+                result = values[root]
+                np.clip(result, 0, 1, out=result)
+                np.multiply(result, 255, out=result)
+                np.add(result, 0.5, out=result)
+                rows[:] = result
+            else:
+                rows[:] = values[root]
+
+        return out
+
+    def evaluate(self, out=None, dtype=np.uint8, chunk_rows=None):
+        """Evaluate the expression into an array of shape (height, width).
+            Args:
+                out (numpy.ndarray): The array into which the mask is written; if None, a new array is created.
+                dtype: numpy.uint8 for values from 0 to 255, or numpy.float32 for values from 0 to 1;
+                    ignored if out is specified; default is numpy.uint8.
+                chunk_rows (int): The number of rows computed at once; if None, the rows of CHUNK_BYTES.
+        """
+        if out is None:
+            out = np.empty((self.height, self.width), dtype=dtype)
+
+        return self.evaluate_rows(0, self.height, out, chunk_rows)
+
+    def get_strip(self, start, stop):
+        """Return the rows from start to stop of the uint8 mask, so that the expression can be
+           passed to output_tiled like generators.
+        """
+        return self.evaluate_rows(start, stop, np.empty((stop - start, self.width), dtype=np.uint8))
+
+    def output_image(self, stem='composite_mask', output_dir=None, with_suffix=True, channels=3, transparent=False):
+        """Evaluate the expression and write it expanded into channels; see utils.expand_mask.
+        """
+        img = expand_mask(self.evaluate(), channels, transparent)
+        return output_image(img, stem, output_dir, with_suffix)
+
+
+class Leaf(Mask):
+    """A mask computed by a generator or cut out of an array.
+    """
+
+    def __init__(self, source, tile_rows=TILE_ROWS, **kwargs):
+        super().__init__('leaf', args=(source, *sorted(kwargs.items(), key=lambda item: item[0])))
+        self.source = source
+        self.kwargs = kwargs
+        self.tile_rows = tile_rows
+        self._tile = None
+
+        if isinstance(source, np.ndarray):
+            if source.ndim != 2:
+                raise ValueError('The array must be a single-channel mask of shape (height, width).')
+            self.height, self.width = source.shape
+        else:
+            self.height, self.width = source.height, source.width
+
+    @property
+    def key(self):
+        if self._key is None:
+            args = tuple((k, key_value(v)) for k, v in self.args[1:])
+            self._key = (self.op, id(self.source), args, ())
+        return self._key
+
+    def get_rows(self, start, stop):
+        if isinstance(self.source, np.ndarray):
+            return self.source[start:stop]
+
+        # A tile of the generator is kept and cut into the chunks.
+        if self._tile is None or not (self._tile[0] <= start and stop <= self._tile[1]):
+            tile_stop = min(self.height, max(stop, start + self.tile_rows))
+            self._tile = (start, tile_stop, self.source.get_strip(start, tile_stop, gray=True, **self.kwargs))
+
+        tile_start, _, tile = self._tile
+        return tile[start - tile_start:stop - tile_start]
+
+    def compute(self, start, stop, values, out):
+        rows = self.get_rows(start, stop)
+
+        if rows.dtype == np.uint8:
+            np.multiply(rows, np.float32(1 / 255), out=out)
+        else:
+            out[:] = rows
+
+
+def mask(source, tile_rows=TILE_ROWS, **kwargs):
+    """Return a leaf of an expression graph of masks.
+        Args:
+            source:
+                A generator instance which has get_strip with gray, like RadialGradientMask or CircleMask,
+                whose first channel is used; or an array of shape (height, width), uint8 from 0 to 255 or float from 0 to 1.
+            tile_rows (int): The number of rows which the generator computes at once; default is TILE_ROWS.
+            **kwargs: Passed to get_strip of the generator; for example, draw and kernel of ShapeMask.get_strip.
+    """
+    return Leaf(source, tile_rows, **kwargs)
+
+
+BLEND_MODES = ('multiply', 'lerp', 'over')
+
+
+def apply_mask(noise, source, mode='multiply', other=0, out=None, chunk_rows=None, **kwargs):
+    """Blend a mask into a float noise array chunk by chunk of rows, so that the whole mask is never created.
+        Args:
+            noise (numpy.ndarray): float32 or float64 array of shape (height, width) or (height, width, channels).
+            source: A Mask, or a generator instance or an array from which mask creates a leaf.
+            mode (str):
+                'multiply': noise * mask.
+                'lerp': other + (noise - other) * mask; noise where the mask is white and other where black.
+                'over': noise, whose last channel is straight alpha, multiplied by the mask
+                and composited over other, which has the alpha channel too; default is 'multiply'.
+            other:
+                The number, the color of the channels, or the array of the same shape as noise
+                with which noise is blended in 'lerp' and 'over'; default is 0.
+            out (numpy.ndarray):
+                The float array into which the result is written; noise itself for blending in place;
+                if None, a new array is created.
+            chunk_rows (int): The number of rows blended at once; if None, the rows of CHUNK_BYTES.
+            **kwargs: Passed to mask if source is not a Mask; for example, draw and kernel of ShapeMask.get_strip.
+    """
+    if mode not in BLEND_MODES:
+        raise ValueError(f'Unknown blend mode: {mode}; choose from {", ".join(BLEND_MODES)}.')
+
+    if noise.dtype not in (np.float32, np.float64):
+        raise ValueError(f'The noise must be float32 or float64, not {noise.dtype}.')
+
+    expr = source if isinstance(source, Mask) else mask(source, **kwargs)
+
+    if noise.shape[:2] != (expr.height, expr.width):
+        raise ValueError(f'The shape of the noise {noise.shape} does not match the mask {(expr.height, expr.width)}.')
+
+    if mode == 'over' and (noise.ndim != 3 or noise.shape[2] < 2):
+        raise ValueError('The noise must have an alpha channel as the last channel in the over mode.')
+
+    if out is None:
+        out = np.empty_like(noise)
+
+    if chunk_rows is None:
+        chunk_rows = max(1, CHUNK_BYTES // (expr.width * 4))
+
+    height = expr.height
+    other = other if isinstance(other, np.ndarray) else np.asarray(other, dtype=noise.dtype)
+    # An array of the image is cut into the chunks, and a number or color is broadcast.
+    rows_of_other = other.ndim >= 2 and other.shape[0] == height
+    buffer = np.empty((chunk_rows, expr.width), dtype=np.float32)
+
+    for start in range(0, height, chunk_rows):
+        stop = min(start + chunk_rows, height)
+        alpha = expr.evaluate_rows(start, stop, buffer[:stop - start], chunk_rows)
+
+        if noise.ndim == 3:
+            alpha = alpha[:, :, np.newaxis]
+
+        src = noise[start:stop]
+        dst = out[start:stop]
+        bg = other[start:stop] if rows_of_other else other
+
+        match mode:
+            case 'multiply':
+                np.multiply(src, alpha, out=dst)
+            case 'lerp':
+                np.subtract(src, bg, out=dst)
+                np.multiply(dst, alpha, out=dst)
+                np.add(dst, bg, out=dst)
+            case 'over':
+                # Straight alpha: a = sa + da * (1 - sa), color = (sc * sa + dc * da * (1 - sa)) / a.
+                src_a = src[:, :, -1:] * alpha
+                bg = np.broadcast_to(bg, src.shape)
+                bg_a = bg[:, :, -1:] * (1 - src_a)
+                a = src_a + bg_a
+                color = dst[:, :, :-1]
+                np.multiply(src[:, :, :-1], src_a, out=color)
+                color += bg[:, :, :-1] * bg_a
+                # Where a is 0, the color is 0 too.
+                np.divide(color, np.maximum(a, np.finfo(a.dtype).tiny), out=color)
+                dst[:, :, -1:] = a
+
+    return out
@@ -0,0 +1,339 @@
+"""Generate datasets of random masks into shards.
+
+    python -m MaskImageGenerator.dataset output --seed 0 --shards 100 --shard-size 1024 --size 256 256 -w 8
+
+Each shard is a stack of uint8 masks of shape (shard_size, height, width), whose parameters are sampled
+from the random generator seeded by the seed and the shard id, so that a seed and a shard id always
+produce the same shard wherever and in whichever order it is generated. A .npz shard holds the masks
+and the parameters of each mask as JSON; a .npy shard is written with the parameters in a .jsonl file.
+index.json lists the shards and the settings of the dataset.
+
+The parameters of a mask reproduce it with the generator classes:
+
+    radial:  RadialGradientMask.create_image(height, width, center_h, center_w, gradient_size,
+                                             inner_to_outer, gray=True)
+    linear:  LinearGradient(height, width, (0,), (255,), (True,)).get_gradient_along(angle)[:, :, 0]
+    circles: CircleMask(height, width, white_circle).create_soft_circles(img, circles, feather, thickness)
+             on create_bg_image(gray=True)
+    lines:   LineMask(height, width, white_lines).create_lines(img, coordinates, line_thickness)
+             on create_bg_image(gray=True), blurred by blur(img, gaussian_kernel, bbox='auto') if not None
+
+The shapes are drawn and blurred by the BACKEND backend, whether OpenCV is installed or not, so that the
+masks do not depend on the machine; set the backend attribute of the generators to it to reproduce them.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .radial_gradient_generator import RadialGradient
+from .shapes.circle_generator import CircleMask
+from .shapes.line_generator import LineMask
+
+
+KINDS = ('radial', 'linear', 'circles', 'lines')
+
+FORMATS = ('npz', 'npy')
+
+# The number of gradients computed at once, which bounds the float64 intermediates.
+BATCH_SIZE = 16
+
+# The backend which draws and blurs the circles and the lines; OpenCV draws other pixels than NumPy.
+BACKEND = 'numpy'
+
+
+def sample_radial(rng, height, width):
+    return dict(
+        center_h=int(rng.integers(0, height + 1)),
+        center_w=int(rng.integers(0, width + 1)),
+        gradient_size=float(rng.uniform(1, 4)),
+        inner_to_outer=bool(rng.integers(2))
+    )
+
+
+def sample_linear(rng, height, width):
+    return dict(angle=float(rng.uniform(0, 360)))
+
+
+def sample_circles(rng, height, width):
+    n = int(rng.integers(1, 9))
+    size = min(height, width)
+    circles = np.column_stack([
+        rng.integers(0, width, n), rng.integers(0, height, n), rng.integers(max(1, size // 20), size // 3 + 2, n)
+    ])
+    return dict(
+        circles=circles.tolist(),
+        feather=int(rng.integers(1, 26)) * 2 + 1,
+        thickness=-1 if rng.random() < 0.7 else int(rng.integers(1, 11)),
+        white_circle=bool(rng.random() < 0.8)
+    )
+
+
+def sample_lines(rng, height, width):
+    n = int(rng.integers(1, 9))
+    points = np.column_stack([rng.integers(0, width, 2 * n), rng.integers(0, height, 2 * n)])
+    return dict(
+        coordinates=points.reshape(n, 2, 2).tolist(),
+        line_thickness=int(rng.integers(1, 11)),
+        gaussian_kernel=None if rng.random() < 0.2 else int(rng.integers(1, 16)) * 2 + 1,
+        white_lines=bool(rng.random() < 0.8)
+    )
+
+
+SAMPLERS = {
+    'radial': sample_radial,
+    'linear': sample_linear,
+    'circles': sample_circles,
+    'lines': sample_lines,
+}
+
+
+def get_weights(weights=None):
+    """Return the probabilities of KINDS from a dict of the relative weights of some of them;
+       if None, all kinds are equally likely.
+    """
+    if weights is None:
+        weights = dict.fromkeys(KINDS, 1)
+
+    if unknown := set(weights) - set(KINDS):
+        raise ValueError(f'Unknown kinds: {", ".join(sorted(unknown))}; choose from {", ".join(KINDS)}.')
+
+    p = np.array([weights.get(kind, 0) for kind in KINDS], dtype=np.float64)
+    return p / p.sum()
+
+
+def sample_shard(seed, shard, shard_size, height=256, width=256, weights=None):
+    """Return the kinds and the parameters of the masks of a shard; the random generator
+       is seeded by seed and shard only.
+    """
+    rng = np.random.default_rng([seed, shard])
+    kinds = rng.choice(len(KINDS), size=shard_size, p=get_weights(weights))
+    return [dict(kind=KINDS[k], **SAMPLERS[KINDS[k]](rng, height, width)) for k in kinds]
+
+
+def render_radial(out, params):
+    """Render radial gradients into out of shape (n, height, width) in batches.
+    """
+    height, width = out.shape[1:]
+    generator = RadialGradient(height, width, inner_color=(0,), outer_color=(255,))
+    inner = np.array([[0] if p['inner_to_outer'] else [255] for p in params])
+
+    chunks = generator.iter_gradient_batch(
+        centers_h=[p['center_h'] for p in params],
+        centers_w=[p['center_w'] for p in params],
+        gradient_sizes=[p['gradient_size'] for p in params],
+        inner_colors=inner,
+        outer_colors=255 - inner,
+        chunk_size=BATCH_SIZE
+    )
+
+    for start, chunk in zip(range(0, len(params), BATCH_SIZE), chunks):
+        out[start:start + len(chunk)] = generator.to_image(chunk[..., 0])
+
+
+def render_linear(out, params):
+    """Render black to white gradients along the angles into out of shape (n, height, width) in batches,
+       which are the same as get_gradient_along of LinearGradient.
+    """
+    height, width = out.shape[1:]
+    y, x = np.ogrid[:height, :width]
+    center = np.array([(width - 1) / 2, (height - 1) / 2])
+
+    for start in range(0, len(params), BATCH_SIZE):
+        rad = np.deg2rad([p['angle'] for p in params[start:start + BATCH_SIZE]])
+        direction = np.column_stack([np.cos(rad), np.sin(rad)])
+        half = (np.abs(direction[:, 0]) * (width - 1) + np.abs(direction[:, 1]) * (height - 1)) / 2
+        start_point = center - direction * half[:, np.newaxis]
+        vec = center + direction * half[:, np.newaxis] - start_point
+        vec /= np.maximum((vec ** 2).sum(axis=1), np.finfo(np.float64).tiny)[:, np.newaxis]
+
+        vx, vy = vec[:, 0, None, None], vec[:, 1, None, None]
+        sx, sy = start_point[:, 0, None, None], start_point[:, 1, None, None]
+        t = ((x - sx) * vx).astype(np.float32) + ((y - sy) * vy).astype(np.float32)
+        np.clip(t, 0, 1, out=t)
+        out[start:start + len(rad)] = t.astype(np.float64) * 255
+
+
+def render_circles(out, params):
+    height, width = out.shape[1:]
+
+    for img, p in zip(out, params):
+        generator = CircleMask(height, width, p['white_circle'])
+        generator.backend = BACKEND
+        img[:] = generator.bg_color[0]
+        generator.create_soft_circles(img, p['circles'], p['feather'], p['thickness'])
+
+
+def render_lines(out, params):
+    height, width = out.shape[1:]
+
+    for img, p in zip(out, params):
+        generator = LineMask(height, width, p['white_lines'])
+        generator.backend = BACKEND
+        img[:] = generator.bg_color[0]
+        generator.create_lines(img, p['coordinates'], p['line_thickness'])
+
+        if p['gaussian_kernel'] is not None:
+            img[:] = generator.blur(img, p['gaussian_kernel'], bbox='auto')
+
+
+RENDERERS = {
+    'radial': render_radial,
+    'linear': render_linear,
+    'circles': render_circles,
+    'lines': render_lines,
+}
+
+
+def render_shard(seed, shard, shard_size, height=256, width=256, weights=None):
+    """Return the masks of a shard in an array of shape (shard_size, height, width) and their parameters.
+       The masks of each kind are rendered together into one buffer, and put back in the sampled order.
+    """
+    params = sample_shard(seed, shard, shard_size, height, width, weights)
+    masks = np.empty((shard_size, height, width), dtype=np.uint8)
+
+    for kind in KINDS:
+        idx = [i for i, p in enumerate(params) if p['kind'] == kind]
+        if not idx:
+            continue
+
+        buf = np.empty((len(idx), height, width), dtype=np.uint8)
+        RENDERERS[kind](buf, [params[i] for i in idx])
+        masks[idx] = buf
+
+    return masks, params
+
+
+def get_shard_path(output_dir, shard, fmt='npz'):
+    return os.path.join(output_dir, f'shard_{shard:06d}.{fmt}')
+
+
+def write_shard(output_dir, seed, shard, shard_size, height=256, width=256, weights=None, fmt='npz'):
+    """Render a shard and write it; return the path and the bytes written.
+       The files are written into temporary files first, so that a partial shard is never left.
+    """
+    masks, params = render_shard(seed, shard, shard_size, height, width, weights)
+    path = get_shard_path(output_dir, shard, fmt)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    lines = [json.dumps(p) for p in params]
+
+    with open(tmp, 'wb') as f:
+        if fmt == 'npz':
+            np.savez(f, masks=masks, params=np.array(lines))
+        else:
+            np.save(f, masks)
+
+    if fmt == 'npy':
+        with open(f'{tmp}.jsonl', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f'{tmp}.jsonl', f'{path[:-4]}.jsonl')
+
+    os.replace(tmp, path)
+    return path, os.path.getsize(path)
+
+
+def load_shard(path):
+    """Return the masks and the parameters of a shard written by write_shard.
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return f['masks'], [json.loads(p) for p in f['params']]
+
+    with open(f'{path[:-4]}.jsonl') as f:
+        return np.load(path), [json.loads(line) for line in f]
+
+
+def generate(output_dir, seed, shards, shard_size=1024, height=256, width=256, weights=None, fmt='npz',
+             workers=None, resume=True):
+    """Write shards on a process pool, and index.json, and return the summary.
+        Args:
+            output_dir (str): The directory into which the shards are written.
+            seed (int): The seed of the dataset.
+            shards (int or iterable): The number of shards, or the shard ids.
+            shard_size (int): The number of masks in a shard; default is 1024.
+            height (int): The height of the masks; default is 256.
+            width (int): The width of the masks; default is 256.
+            weights (dict): The relative weights of the kinds; if None, all kinds are equally likely.
+            fmt (str): 'npz' or 'npy'; default is 'npz'.
+            workers (int): The number of worker processes; if None, the number of CPUs.
+            resume (bool): If True, the shards which already exist are skipped.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format: {fmt}; choose from {", ".join(FORMATS)}.')
+
+    get_weights(weights)
+    os.makedirs(output_dir, exist_ok=True)
+    ids = list(range(shards)) if isinstance(shards, int) else list(shards)
+    todo = [i for i in ids if not (resume and os.path.exists(get_shard_path(output_dir, i, fmt)))]
+    summary = dict(total=len(ids), skipped=len(ids) - len(todo), done=0, failed=0, bytes=0)
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(write_shard, output_dir, seed, i, shard_size, height, width, weights, fmt): i
+            for i in todo
+        }
+
+        for future in as_completed(futures):
+            try:
+                summary['bytes'] += future.result()[1]
+                summary['done'] += 1
+            except Exception as e:
+                summary['failed'] += 1
+                print(f'shard {futures[future]}: {e!r}', file=sys.stderr)
+
+    index = dict(
+        seed=seed,
+        shard_size=shard_size,
+        height=height,
+        width=width,
+        weights=dict(zip(KINDS, get_weights(weights).tolist())),
+        format=fmt,
+        backend=BACKEND,
+        shards=[dict(shard=i, file=os.path.basename(get_shard_path(output_dir, i, fmt))) for i in ids
+                if os.path.exists(get_shard_path(output_dir, i, fmt))]
+    )
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+
+    summary['seconds'] = time.perf_counter() - start
+    elapsed = max(summary['seconds'], 1e-9)
+    summary['masks_per_sec'] = summary['done'] * shard_size / elapsed
+    summary['mb_per_sec'] = summary['bytes'] / 1024 ** 2 / elapsed
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a dataset of random masks into shards.')
+    parser.add_argument('output_dir', help='The directory into which the shards are written.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the dataset.')
+    parser.add_argument('--shards', type=int, default=1, help='The number of shards.')
+    parser.add_argument('--shard-size', type=int, default=1024, help='The number of masks in a shard.')
+    parser.add_argument('--size', type=int, nargs=2, default=(256, 256), metavar=('HEIGHT', 'WIDTH'),
+                        help='The height and width of the masks.')
+    parser.add_argument('--weights', type=json.loads, default=None,
+                        help='The relative weights of the kinds as JSON, like \'{"radial": 2, "lines": 1}\'.')
+    parser.add_argument('--format', choices=FORMATS, default='npz', help='The format of the shards.')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='The number of worker processes.')
+    parser.add_argument('--no-resume', action='store_true', help='Regenerate the shards which already exist.')
+    args = parser.parse_args(argv)
+
+    summary = generate(
+        args.output_dir, args.seed, args.shards, args.shard_size, *args.size, args.weights, args.format,
+        args.workers, not args.no_resume
+    )
+
+    print(
+        f'{summary["done"]} shards done, {summary["skipped"]} skipped, {summary["failed"]} failed '
+        f'in {summary["seconds"]:.2f} s: {summary["masks_per_sec"]:.1f} masks/s, '
+        f'{summary["mb_per_sec"]:.2f} MB/s written'
+    )
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
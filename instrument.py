@@ -0,0 +1,148 @@
+import functools
+import threading
+import time
+import tracemalloc
+
+
+# The active Recorders; the stages are not measured while it is empty.
+_recorders = []
+
+# The stack of the peaks of the stages being measured on each thread; a stage resets the peak of tracemalloc,
+# so that the peak reached before it in the enclosing stages is kept here.
+_local = threading.local()
+
+
+class StageStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.min_seconds = float('inf')
+        self.max_seconds = 0.0
+        self.total_bytes = 0
+        self.max_bytes = 0
+
+    def add(self, seconds, nbytes):
+        self.count += 1
+        self.total_seconds += seconds
+        self.min_seconds = min(self.min_seconds, seconds)
+        self.max_seconds = max(self.max_seconds, seconds)
+
+        if nbytes is not None:
+            self.total_bytes += nbytes
+            self.max_bytes = max(self.max_bytes, nbytes)
+
+    def as_dict(self):
+        return dict(
+            count=self.count,
+            total_seconds=self.total_seconds,
+            mean_seconds=self.total_seconds / self.count if self.count else 0.0,
+            min_seconds=self.min_seconds if self.count else 0.0,
+            max_seconds=self.max_seconds,
+            total_bytes=self.total_bytes,
+            max_bytes=self.max_bytes
+        )
+
+
+class Recorder:
+    """A class to record the wall time and allocated bytes of each stage of the generators,
+       like background, draw, blur, bgr, alpha, gradient, quantize and write, while used as a context manager.
+        Args:
+            callback (callable):
+                Called as callback(stage, seconds, nbytes) every time a stage finishes;
+                nbytes is None if memory is not traced.
+            trace_memory (bool):
+                If True, tracemalloc is started to measure the peak bytes allocated by each stage,
+                which slows the stages down; default is False.
+    """
+
+    def __init__(self, callback=None, trace_memory=False):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+        self._lock = threading.Lock()
+        self._started_tracing = False
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+        _recorders.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _recorders.remove(self)
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def record(self, stage, seconds, nbytes=None):
+        with self._lock:
+            self.stages.setdefault(stage, StageStats()).add(seconds, nbytes)
+
+        if self.callback is not None:
+            self.callback(stage, seconds, nbytes)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {stage: stats.as_dict() for stage, stats in self.stages.items()}
+
+    def report(self):
+        lines = [f'{"stage":<12}{"count":>8}{"total s":>12}{"mean ms":>12}{"max ms":>12}{"max MB":>10}']
+
+        for stage, s in sorted(self.stats.items(), key=lambda item: -item[1]['total_seconds']):
+            lines.append(
+                f'{stage:<12}{s["count"]:>8}{s["total_seconds"]:>12.4f}{s["mean_seconds"] * 1e3:>12.3f}'
+                f'{s["max_seconds"] * 1e3:>12.3f}{s["max_bytes"] / 1024 ** 2:>10.1f}'
+            )
+
+        return '\n'.join(lines)
+
+
+def measure(stage, func, args, kwargs):
+    tracing = tracemalloc.is_tracing()
+
+    if tracing:
+        if not hasattr(_local, 'peaks'):
+            _local.peaks = []
+        peaks = _local.peaks
+
+        current, peak = tracemalloc.get_traced_memory()
+        if peaks:
+            peaks[-1] = max(peaks[-1], peak)
+        peaks.append(current)
+        tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    finally:
+        if tracing:
+            peak = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+
+    nbytes = peak - current if tracing else None
+
+    for recorder in list(_recorders):
+        recorder.record(stage, seconds, nbytes)
+
+    return result
+
+
+def stage(name):
+    """A decorator to record the function as a stage while a Recorder is active.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _recorders:
+                return func(*args, **kwargs)
+            return measure(name, func, args, kwargs)
+
+        return wrapper
+
+    return decorator
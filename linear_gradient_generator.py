@@ -1,6 +1,11 @@
+import copy
+
 import numpy as np
 
-from .utils import output_image
+from .instrument import stage
+from .lowres import get_sample_offset, get_sample_size
+from .tiling import render
+from .utils import DTYPE_MAX, check_dtype, expand_mask, invert_mask, output_image
 
 
 class LinearGradient:
@@ -19,6 +24,12 @@ class LinearGradient:
                 the number of elements must be the same as start_color and end_color.
     """
 
+    # True for the classes whose last channel is alpha, 255 minus the color.
+    transparent = False
+
+    # (factor, offset, height, width) of the image which get_scaled samples; None for the image itself.
+    _sampling = None
+
     def __init__(self, height, width, start_color, end_color, is_horizontal):
         self.height = height
         self.width = width
@@ -26,26 +37,161 @@ class LinearGradient:
         self.end_color = end_color
         self.is_horizontal = is_horizontal
 
-    def get_gradient_2d(self, start, stop, is_horizontal):
+    def get_ramp(self, start, stop, is_horizontal):
+        size = self.width if is_horizontal else self.height
+
+        if self._sampling is None:
+            return np.linspace(start, stop, size)
+
+        factor, offset, height, width = self._sampling
+        full = width if is_horizontal else height
+        t = (np.arange(size) * factor + offset) / max(full - 1, 1)
+        return start + (stop - start) * np.clip(t, 0, 1)
+
+    def get_scaled(self, factor, pad=0):
+        """Return the generator whose image is this gradient sampled every factor pixels,
+           with pad samples added outside each edge; see lowres.
+        """
+        scaled = copy.copy(self)
+        scaled.height = get_sample_size(self.height, factor, pad)
+        scaled.width = get_sample_size(self.width, factor, pad)
+        scaled._sampling = (factor, get_sample_offset(factor, pad), self.height, self.width)
+        return scaled
+
+    def get_gradient_2d(self, start, stop, is_horizontal, lazy=False):
+        """Return the gradient of a channel as an array of shape (height, width).
+           If lazy is True, a read-only view which shares the memory of the 1D ramp is returned.
+        """
+        ramp = self.get_ramp(start, stop, is_horizontal)
+
+        if lazy:
+            ramp = ramp if is_horizontal else ramp[:, np.newaxis]
+            return np.broadcast_to(ramp, (self.height, self.width))
+
         if is_horizontal:
-            return np.tile(np.linspace(start, stop, self.width), (self.height, 1))
+            return np.tile(ramp, (self.height, 1))
 
-        return np.tile(np.linspace(start, stop, self.height), (self.width, 1)).T
+        return np.tile(ramp, (self.width, 1)).T
 
     def get_gradient_3d(self):
-        arr = np.zeros((self.height, self.width, len(self.is_horizontal)), dtype=np.uint8)
+        # The uint8 ramps are broadcast into the array without the float64 intermediates.
+        return self.get_strip(0, self.height)
+
+    def get_gradient_view(self):
+        """Return the gradient as a read-only view of shape (height, width, channels) which
+           shares the memory of one uint8 ramp per channel; it needs the same direction for all channels,
+           otherwise the array which get_gradient_3d returns is made read-only.
+        """
+        channels = len(self.is_horizontal)
+
+        if all(self.is_horizontal):
+            ramps = np.empty((1, self.width, channels), dtype=np.uint8)
+        elif not any(self.is_horizontal):
+            ramps = np.empty((self.height, 1, channels), dtype=np.uint8)
+        else:
+            arr = self.get_gradient_3d()
+            arr.flags.writeable = False
+            return arr
 
         for i, (start, stop, is_hor) in enumerate(
-                zip(self.start_color, self.end_color, self.is_horizontal)):
-            arr[:, :, i] = self.get_gradient_2d(start, stop, is_hor)
+                zip(self.start_color[:channels - self.transparent], self.end_color, self.is_horizontal)):
+            ramps[:, :, i] = self.get_ramp(start, stop, is_hor).reshape(ramps.shape[:2])
+
+        if self.transparent:
+            invert_mask(ramps[:, :, 0], out=ramps[:, :, -1])
+
+        return np.broadcast_to(ramps, (self.height, self.width, channels))
+
+    @stage('gradient')
+    def get_strip(self, start, stop, gray=False):
+        """Return the rows from start to stop of the array that get_gradient_3d returns.
+           If gray is True, the rows of the first channel are returned.
+        """
+        if gray:
+            is_hor = self.is_horizontal[0]
+            ramp = self.get_ramp(self.start_color[0], self.end_color[0], is_hor)
+            arr = np.empty((stop - start, self.width), dtype=np.uint8)
+            arr[:] = ramp if is_hor else ramp[start:stop, np.newaxis]
+            return arr
+
+        channels = len(self.is_horizontal)
+        arr = np.zeros((stop - start, self.width, channels), dtype=np.uint8)
+
+        # The alpha of transparent classes is derived from the first channel like expand.
+        for i, (start_c, stop_c, is_hor) in enumerate(
+                zip(self.start_color[:channels - self.transparent], self.end_color, self.is_horizontal)):
+            ramp = self.get_ramp(start_c, stop_c, is_hor)
+            arr[:, :, i] = ramp if is_hor else ramp[start:stop, np.newaxis]
+
+        if self.transparent:
+            invert_mask(arr[:, :, 0], out=arr[:, :, -1])
+
+        return arr
+
+    def expand(self, mask, view=False):
+        """Expand a single-channel mask into the image of all channels;
+           the alpha channel of transparent classes is derived from the mask at the same time.
+        """
+        return expand_mask(mask, len(self.is_horizontal), self.transparent, view)
+
+    @stage('gradient')
+    def get_gradient_along(self, angle=0, stops=None, start_point=None, end_point=None, dtype=np.uint8):
+        """Return a gradient along any direction, which has all channels in the same direction.
+            Args:
+                angle (float):
+                    The direction of the gradient in degrees; 0 is from the left to right,
+                    90 is from the top to bottom; the gradient spans the whole image; default is 0.
+                stops (list):
+                    Pairs of a position from 0 to 1 in ascending order and a color of values ranging from 0 to 255,
+                    like [(0, (0, 0, 0)), (0.5, (255, 0, 0)), (1, (255, 255, 255))];
+                    if None, start_color and end_color are used.
+                start_point (tuple): (x, y) where the gradient starts; used instead of angle with end_point.
+                end_point (tuple): (x, y) where the gradient ends; used instead of angle with start_point.
+                dtype: numpy.uint8, numpy.uint16 or numpy.float32; 255 is scaled to 65535 for uint16 and 1.0 for float32.
+        """
+        if stops is None:
+            stops = [(0, self.start_color), (1, self.end_color)]
+
+        positions = np.array([pos for pos, _ in stops], dtype=np.float64)
+        colors = np.array([color for _, color in stops], dtype=np.float64)
+
+        if np.any(np.diff(positions) < 0):
+            raise ValueError('The positions of stops must be in ascending order.')
+
+        if start_point is None or end_point is None:
+            rad = np.deg2rad(angle)
+            direction = np.array([np.cos(rad), np.sin(rad)])
+            center = np.array([(self.width - 1) / 2, (self.height - 1) / 2])
+            half = (abs(direction[0]) * (self.width - 1) + abs(direction[1]) * (self.height - 1)) / 2
+            start_point = center - direction * half
+            end_point = center + direction * half
+
+        start_point = np.asarray(start_point, dtype=np.float64)
+        vec = np.asarray(end_point, dtype=np.float64) - start_point
+        vec /= max(np.dot(vec, vec), np.finfo(np.float64).tiny)
+
+        # The position of every pixel is the dot product of its coordinates and the direction.
+        y, x = np.ogrid[:self.height, :self.width]
+        t = ((x - start_point[0]) * vec[0]).astype(np.float32) + ((y - start_point[1]) * vec[1]).astype(np.float32)
+
+        dtype = check_dtype(dtype)
+        scale = DTYPE_MAX[dtype.type] / 255
+        arr = np.empty((self.height, self.width, colors.shape[1]), dtype=dtype)
+
+        for i in range(colors.shape[1]):
+            arr[:, :, i] = np.interp(t, positions, colors[:, i] * scale)
 
         return arr
 
     @staticmethod
-    def output_image(height, width, start_color, end_color, is_horizontal,
-                     output_dir=None, with_suffix=True):
+    def create_image(height, width, start_color, end_color, is_horizontal, workers=None):
         generator = LinearGradient(height, width, start_color, end_color, is_horizontal)
-        arr = generator.get_gradient_3d()
+        return render(generator, workers)
+
+    @staticmethod
+    def output_image(height, width, start_color, end_color, is_horizontal,
+                     output_dir=None, with_suffix=True, *, workers=None):
+        arr = LinearGradient.create_image(height, width, start_color, end_color, is_horizontal, workers)
         output_image(arr, 'linear_gradient', output_dir, with_suffix)
 
 
@@ -69,10 +215,15 @@ class HorizontalGradientMask(LinearGradient):
         )
 
     @staticmethod
-    def output_image(height=256, width=256, left_to_right=True,
-                     output_dir=None, with_suffix=True):
+    def create_image(height=256, width=256, left_to_right=True, gray=False, workers=None):
         generator = HorizontalGradientMask(height, width, left_to_right)
-        arr = generator.get_gradient_3d()
+        mask = render(generator, workers, gray=True)
+        return mask if gray else generator.expand(mask)
+
+    @staticmethod
+    def output_image(height=256, width=256, left_to_right=True,
+                     output_dir=None, with_suffix=True, *, workers=None):
+        arr = HorizontalGradientMask.create_image(height, width, left_to_right, workers=workers)
         output_image(arr, 'horizontal_gradient', output_dir, with_suffix)
 
 
@@ -86,6 +237,8 @@ class TransparentHorizontalGradientMask(LinearGradient):
                 from black to transparent white; if False, from the right to left, it does.
     """
 
+    transparent = True
+
     def __init__(self, height=256, width=256, left_to_right=True):
         super().__init__(
             height=height,
@@ -96,10 +249,15 @@ class TransparentHorizontalGradientMask(LinearGradient):
         )
 
     @staticmethod
-    def output_image(height=256, width=256, left_to_right=True,
-                     output_dir=None, with_suffix=True):
+    def create_image(height=256, width=256, left_to_right=True, gray=False, workers=None):
         generator = TransparentHorizontalGradientMask(height, width, left_to_right)
-        arr = generator.get_gradient_3d()
+        mask = render(generator, workers, gray=True)
+        return mask if gray else generator.expand(mask)
+
+    @staticmethod
+    def output_image(height=256, width=256, left_to_right=True,
+                     output_dir=None, with_suffix=True, *, workers=None):
+        arr = TransparentHorizontalGradientMask.create_image(height, width, left_to_right, workers=workers)
         output_image(arr, 'trans_horizontal_gradient', output_dir, with_suffix)
 
 
@@ -123,10 +281,15 @@ class VerticalGradientMask(LinearGradient):
         )
 
     @staticmethod
-    def output_image(height=256, width=256, top_to_bottom=True,
-                     output_dir=None, with_suffix=True):
+    def create_image(height=256, width=256, top_to_bottom=True, gray=False, workers=None):
         generator = VerticalGradientMask(height, width, top_to_bottom)
-        arr = generator.get_gradient_3d()
+        mask = render(generator, workers, gray=True)
+        return mask if gray else generator.expand(mask)
+
+    @staticmethod
+    def output_image(height=256, width=256, top_to_bottom=True,
+                     output_dir=None, with_suffix=True, *, workers=None):
+        arr = VerticalGradientMask.create_image(height, width, top_to_bottom, workers=workers)
         output_image(arr, 'vertical_gradient', output_dir, with_suffix)
 
 
@@ -140,6 +303,8 @@ class TransparentVerticalGradientMask(LinearGradient):
                 from black to transparent white; if False, from the bottom to top, it does.
     """
 
+    transparent = True
+
     def __init__(self, height=256, width=256, top_to_bottom=True):
         super().__init__(
             height=height,
@@ -150,10 +315,15 @@ class TransparentVerticalGradientMask(LinearGradient):
         )
 
     @staticmethod
-    def output_image(height=256, width=256, top_to_bottom=True,
-                     output_dir=None, with_suffix=True):
+    def create_image(height=256, width=256, top_to_bottom=True, gray=False, workers=None):
         generator = TransparentVerticalGradientMask(height, width, top_to_bottom)
-        arr = generator.get_gradient_3d()
+        mask = render(generator, workers, gray=True)
+        return mask if gray else generator.expand(mask)
+
+    @staticmethod
+    def output_image(height=256, width=256, top_to_bottom=True,
+                     output_dir=None, with_suffix=True, *, workers=None):
+        arr = TransparentVerticalGradientMask.create_image(height, width, top_to_bottom, workers=workers)
         output_image(arr, 'trans_vertical_gradient', output_dir, with_suffix)
 
 
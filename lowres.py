@@ -0,0 +1,133 @@
+"""Synthesize smooth images at a reduced resolution and upsample them.
+
+    from lowres import choose_scale
+    from radial_gradient_generator import RadialGradientMask
+
+    params = dict(height=4096, width=4096)
+    scale, errors = choose_scale(RadialGradientMask, params, tolerance=1)
+    img = RadialGradientMask.create_image(**params, scale=scale)
+
+The image is sampled every scale pixels, at the positions which cv2.resize expects when it upsamples
+by the integer factor, so that every sample is at the same position as the pixel of the full-resolution image;
+samples are added around the edges, which the interpolation reads, and cut off after upsampled.
+The error against the full-resolution image depends on the size and the parameters,
+so that choose_scale measures it with the parameters which are actually used.
+"""
+import numpy as np
+
+from .shapes import backends
+from .tiling import render
+from .utils import DTYPE_MAX, check_dtype, cv2
+
+
+INTERPOLATIONS = ('bilinear', 'bicubic')
+
+# The samples added outside each edge; the bicubic interpolation reads 2 samples on each side.
+PADS = {'bilinear': 1, 'bicubic': 2}
+
+# The scales which choose_scale tries.
+DEFAULT_SCALES = (2, 4, 8, 16)
+
+
+def check_interpolation(interpolation):
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(f'Unknown interpolation: {interpolation}; choose from {", ".join(INTERPOLATIONS)}.')
+
+
+def get_sample_offset(factor, pad=0):
+    """Return the position in the full-resolution image of the first sample, from which the samples are
+       every factor pixels; cv2.resize puts the center of a sample at the center of factor pixels.
+    """
+    return (factor - 1) / 2 - pad * factor
+
+
+def get_sample_size(size, factor, pad=0):
+    return -(-size // factor) + 2 * pad
+
+
+def upsample(small, factor, height, width, interpolation='bilinear'):
+    """Upsample the samples returned by the generator of get_scaled by the integer factor,
+       and cut the image of height x width out of it.
+    """
+    check_interpolation(interpolation)
+    top = PADS[interpolation] * factor
+
+    if backends.get_backend() != 'numpy':
+        flag = cv2.INTER_LINEAR if interpolation == 'bilinear' else cv2.INTER_CUBIC
+        big = cv2.resize(small, None, fx=factor, fy=factor, interpolation=flag)
+        return np.ascontiguousarray(big[top:top + height, top:top + width])
+
+    if interpolation != 'bilinear':
+        raise ValueError('The bicubic interpolation needs OpenCV.')
+
+    channels = [small] if small.ndim == 2 else [small[..., c] for c in range(small.shape[2])]
+    big_h, big_w = small.shape[0] * factor, small.shape[1] * factor
+    arrs = [backends.resize_linear(c.astype(np.float32), factor, big_h, big_w)[top:top + height, top:top + width]
+            for c in channels]
+    arr = arrs[0] if small.ndim == 2 else np.stack(arrs, axis=-1)
+
+    if small.dtype == np.uint8:
+        return backends.to_uint8(arr)
+    if small.dtype.kind == 'u':
+        np.rint(arr, out=arr)
+    return arr.astype(small.dtype)
+
+
+def render_scaled(generator, scale=1, interpolation='bilinear', workers=None, out=None, **kwargs):
+    """Generate the whole image at 1 / scale of the resolution, and upsample it by interpolation.
+        Args:
+            generator: An instance of a generator class, which has get_strip and get_scaled methods.
+            scale (int): The integer factor; if 1, the image is generated at the full resolution.
+            interpolation (str): 'bilinear' or 'bicubic'; default is 'bilinear'.
+            workers (int): The number of threads generating the samples; see tiling.render.
+            out (numpy.ndarray):
+                The array into which the image is written; see tiling.render. With scale,
+                the upsampled image is copied into it.
+            **kwargs: Passed to get_strip; for example, gray.
+    """
+    if scale <= 1:
+        return render(generator, workers, out=out, **kwargs)
+
+    check_interpolation(interpolation)
+    small = render(generator.get_scaled(scale, PADS[interpolation]), workers, **kwargs)
+    img = upsample(small, scale, generator.height, generator.width, interpolation)
+
+    if out is None:
+        return img
+
+    out[:] = img
+    return out
+
+
+def measure_error(cls, params, scale, interpolation='bilinear'):
+    """Return the maximum and mean absolute errors per pixel of create_image of the generator class
+       with scale against the full-resolution image of the same params, in the values of its dtype.
+    """
+    full = cls.create_image(**params)
+    approx = cls.create_image(**params, scale=scale, interpolation=interpolation)
+    diff = np.abs(full.astype(np.float64) - approx)
+
+    return dict(
+        scale=scale,
+        interpolation=interpolation,
+        max_error=float(diff.max()),
+        mean_error=float(diff.mean())
+    )
+
+
+def choose_scale(cls, params, tolerance=1, scales=DEFAULT_SCALES, interpolation='bilinear'):
+    """Return the largest of scales whose maximum error per pixel is within tolerance, or 1 if none,
+       and the errors of all of the scales measured by measure_error.
+        Args:
+            cls: A generator class whose create_image has scale and interpolation.
+            params (dict): The parameters of create_image.
+            tolerance (float):
+                The maximum error allowed in values from 0 to 255, which is scaled like the image
+                to the dtype in params: by 65535 / 255 for uint16 and 1 / 255 for float32; default is 1.
+            scales (tuple): The integer factors which are tried.
+            interpolation (str): 'bilinear' or 'bicubic'; default is 'bilinear'.
+    """
+    limit = tolerance * DTYPE_MAX[check_dtype(params.get('dtype', np.uint8)).type] / 255
+    errors = [measure_error(cls, params, scale, interpolation) for scale in scales]
+    passed = [e['scale'] for e in errors if e['max_error'] <= limit]
+    return max(passed, default=1), errors
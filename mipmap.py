@@ -0,0 +1,147 @@
+"""Generate the full mip chains of images for textures.
+
+    from mipmap import create_mipmaps, get_level, output_mipmaps
+    from radial_gradient_generator import RadialGradientMask
+    from shapes.circle_generator import CircleMask
+
+    buffer, layout = create_mipmaps(RadialGradientMask(1024, 1024), gray=True)
+    level_2 = get_level(buffer, layout[2])
+
+    circles = CircleMask(1024, 1024)
+    output_mipmaps(circles, 'circle_mips', draw=lambda img, offset: circles.create_circle(img, 300, offset=offset),
+                   kernel=51, gray=True)
+
+The size of a level is half of the previous one rounded down, and 1 at least, down to 1 x 1.
+The gradients, which have get_scaled, are computed directly at the resolution of each level,
+sampled at the centers of the blocks of 2 ** level pixels; the other generators, like the blurred shapes,
+are generated at the full resolution and reduced by 2 x 2 averages level by level.
+All levels are packed into one contiguous buffer of bytes, and the layout gives the offset of each level in it;
+the levels have the dtype of the image, like uint16 or float32 with dtype of RadialGradient.get_strip.
+"""
+import json
+
+import numpy as np
+
+from .tiling import render
+from .utils import make_path
+
+
+def get_level_shapes(height, width, levels=None):
+    """Return (height, width) of each level; all levels down to 1 x 1, if levels is None.
+    """
+    shapes = [(height, width)]
+
+    while (levels is None or len(shapes) < levels) and shapes[-1] != (1, 1):
+        h, w = shapes[-1]
+        shapes.append((max(1, h // 2), max(1, w // 2)))
+
+    return shapes
+
+
+def get_layout(shapes, channels=None, dtype=np.uint8):
+    """Return the level, height, width, channels, dtype, offset and nbytes of each level packed in order.
+    """
+    dtype = np.dtype(dtype)
+    layout = []
+    offset = 0
+
+    for level, (h, w) in enumerate(shapes):
+        nbytes = h * w * (channels or 1) * dtype.itemsize
+        layout.append(dict(level=level, height=h, width=w, channels=channels, dtype=dtype.name,
+                           offset=offset, nbytes=nbytes))
+        offset += nbytes
+
+    return layout
+
+
+def get_level(buffer, entry):
+    """Return the view of a level in the buffer of bytes.
+    """
+    shape = (entry['height'], entry['width']) + ((entry['channels'],) if entry['channels'] else ())
+    return buffer[entry['offset']:entry['offset'] + entry['nbytes']].view(entry['dtype']).reshape(shape)
+
+
+def reduce_level(src, dst):
+    """Write the averages of 2 x 2 pixels of src into dst, rounded for integers; an axis whose size is 1
+       in dst and src is not halved, and the last row or column of an odd size is dropped.
+    """
+    h, w = dst.shape[:2]
+    fy, fx = (2 if size > 1 else 1 for size in src.shape[:2])
+    blocks = src[:h * fy, :w * fx].reshape((h, fy, w, fx) + src.shape[2:])
+
+    if src.dtype.kind == 'f':
+        dst[:] = blocks.mean(axis=(1, 3))
+        return
+
+    n = fy * fx
+    total = blocks.sum(axis=(1, 3), dtype=np.uint32)
+    total += n // 2
+    np.floor_divide(total, n, out=total)
+    dst[:] = total
+
+
+def get_level_generator(generator, level, height, width):
+    scaled = generator.get_scaled(2 ** level)
+    # The last block of an odd size is dropped like the 2 x 2 averages.
+    scaled.height, scaled.width = height, width
+    return scaled
+
+
+def create_mipmaps(generator, levels=None, **kwargs):
+    """Return the buffer of bytes into which all levels of the image of a generator are packed, and the layout;
+       level 0 is the same as the image which render(generator, **kwargs) returns.
+        Args:
+            generator: An instance of a generator class, which has get_strip method.
+            levels (int): The number of levels; if None, all levels down to 1 x 1.
+            **kwargs:
+                Passed to get_strip; for example, gray and dtype of RadialGradient.get_strip,
+                and draw and kernel of ShapeMask.get_strip.
+    """
+    shapes = get_level_shapes(generator.height, generator.width, levels)
+    base = render(generator, **kwargs)
+    channels = base.shape[2] if base.ndim == 3 else None
+    layout = get_layout(shapes, channels, base.dtype)
+    buffer = np.empty(layout[-1]['offset'] + layout[-1]['nbytes'], dtype=np.uint8)
+
+    prev = get_level(buffer, layout[0])
+    prev[:] = base
+    del base
+
+    for entry in layout[1:]:
+        level = get_level(buffer, entry)
+
+        if hasattr(generator, 'get_scaled'):
+            scaled = get_level_generator(generator, entry['level'], entry['height'], entry['width'])
+            level[:] = scaled.get_strip(0, entry['height'], **kwargs)
+        else:
+            reduce_level(prev, level)
+
+        prev = level
+
+    return buffer, layout
+
+
+def output_mipmaps(generator, stem, output_dir=None, with_suffix=True, levels=None, **kwargs):
+    """Write the buffer of create_mipmaps into a .mip file with one write, and the layout into a .json file
+       of the same stem; return the path of the .mip file.
+    """
+    buffer, layout = create_mipmaps(generator, levels, **kwargs)
+    path = make_path(stem, '.mip', output_dir, with_suffix)
+
+    with open(path, 'wb') as f:
+        f.write(buffer)
+
+    with open(f'{path[:-4]}.json', 'w') as f:
+        json.dump(dict(levels=layout), f, indent=2)
+
+    return path
+
+
+def load_mipmaps(path):
+    """Return the views of the levels of a .mip file written by output_mipmaps.
+    """
+    with open(f'{path[:-4]}.json') as f:
+        layout = json.load(f)['levels']
+
+    buffer = np.fromfile(path, dtype=np.uint8)
+    return [get_level(buffer, entry) for entry in layout]
@@ -1,6 +1,59 @@
+import copy
+import functools
+import threading
+
 import numpy as np
 
-from .utils import output_image
+from .instrument import stage
+from .lowres import get_sample_offset, get_sample_size, render_scaled
+from .shapes import backends
+from .utils import DTYPE_MAX, check_dtype, cv2, expand_mask, invert_mask, output_image
+
+
+# The number of rows of a distance field computed at once.
+FIELD_CHUNK_ROWS = 256
+
+# The bytes of a float buffer of the rows computed at once by get_strip, which stays in the cache.
+CHUNK_BYTES = 2 ** 18
+
+def quantize(arr, dtype=np.uint8, out=None):
+    """Scale the float values from 0 to 1 of arr to dtype in place, and write them clipped into out;
+       the clip and the cast are done in one pass. uint8 values are truncated like astype,
+       and uint16 values are rounded. arr is overwritten.
+    """
+    dtype = check_dtype(dtype)
+    top = DTYPE_MAX[dtype.type]
+
+    if top != 1:
+        np.multiply(arr, top, out=arr)
+    if dtype.type is np.uint16:
+        np.rint(arr, out=arr)
+    if out is None:
+        out = np.empty(arr.shape, dtype=dtype)
+
+    np.clip(arr, 0, top, out=out, casting='unsafe')
+    return out
+
+
+@functools.lru_cache(maxsize=4)
+def get_distance_field(height, width, gradient_size):
+    """Return the distance field of shape (2 * height, 2 * width) around the center (width, height),
+       normalized like RadialGradient.get_distance and quantized into uint8 levels, floor(distance * 255).
+       The field around any center in an image of height x width is a slice of it.
+    """
+    field = np.empty((2 * height, 2 * width), dtype=np.uint8)
+    x = np.arange(-width, width, dtype=np.float64)
+    scale = 2 ** 0.5 * max(height, width) / gradient_size
+
+    for start in range(0, 2 * height, FIELD_CHUNK_ROWS):
+        y = np.arange(start - height, min(start + FIELD_CHUNK_ROWS, 2 * height) - height, dtype=np.float64)
+        # The same arithmetic as get_distance, so that the levels are the same as the quantized gradients.
+        dist = (x ** 2 + y[:, np.newaxis] ** 2) ** 0.5 / scale
+        np.minimum(dist, 1, out=dist)
+        field[start:start + len(y)] = dist * 255
+
+    field.flags.writeable = False
+    return field
 
 
 class RadialGradient:
@@ -20,6 +73,9 @@ class RadialGradient:
             center_w (int): x-axis center; must be positive; width // 2, if not specified.
     """
 
+    # True for the classes whose last channel is alpha, 255 minus the color.
+    transparent = False
+
     def __init__(self, height, width, inner_color, outer_color,
                  gradient_size=2, center_h=None, center_w=None):
         self.height = height
@@ -36,6 +92,11 @@ class RadialGradient:
         self.max_length = max(self.height, self.width)
         self.channels = len(self.inner_color)
 
+        # The colors which the lookup table is made from, and the table.
+        self._lut = (None, None)
+        # The float buffers of get_strip, which are reused on each thread.
+        self._buffers = threading.local()
+
     @property
     def center_w(self):
         return self._center[0]
@@ -73,24 +134,291 @@ class RadialGradient:
         rgb = [self.outer_color[i] * dist + self.inner_color[i] * (1 - dist) for i in range(self.channels)]
         return rgb
 
-    def get_gradient_array(self):
-        arr = np.array(
-            [self.get_gradient(x, y)
-                for y in range(self.height)
-                for x in range(self.width)]
+    def get_gradient_array(self, gray=False):
+        """Return the gradient of the whole image; the distance field is computed
+           at once from the row and column vectors instead of pixel by pixel.
+           If gray is True, only the first channel is computed into an array of shape (height, width).
+        """
+        return self.get_gradient_rows(0, self.height, gray)
+
+    @stage('gradient')
+    def get_gradient_rows(self, start, stop, gray=False):
+        y, x = np.ogrid[start:stop, :self.width]
+        dist = self.get_distance(x, y)
+        np.minimum(dist, 1, out=dist)
+
+        if gray:
+            return self.outer_color[0] * dist + self.inner_color[0] * (1 - dist)
+
+        dist = dist[:, :, np.newaxis]
+
+        inner_color = np.array(self.inner_color)
+        outer_color = np.array(self.outer_color)
+        arr = outer_color * dist + inner_color * (1 - dist)
+        return arr
+
+    def get_buffers(self, rows, float_type):
+        """Return 3 float buffers of shape (rows, width), which are reused by get_strip on this thread.
+        """
+        buffers = getattr(self._buffers, 'arrays', None)
+
+        if buffers is None or buffers.shape[1:] != (rows, self.width) or buffers.dtype != float_type:
+            buffers = self._buffers.arrays = np.empty((3, rows, self.width), dtype=float_type)
+
+        return buffers
+
+    @stage('gradient')
+    def get_strip(self, start, stop, gray=False, dtype=np.uint8, out=None):
+        """Return the rows from start to stop of the image that output writes. The rows are computed
+           in chunks in float buffers reused on each thread, and quantized into out, so that no array
+           of the size of the image is allocated but out; calling this method of one instance with out
+           in a loop allocates nothing after the first call, while create_image creates a new instance
+           and its buffers every time.
+            Args:
+                start (int): The first row.
+                stop (int): The row after the last.
+                gray (bool): If True, the rows of the first channel are returned.
+                dtype:
+                    numpy.uint8, numpy.uint16 or numpy.float32; 255 is scaled to 65535 for uint16
+                    and 1.0 for float32. uint8 is computed in float64, so that the images are the same
+                    as before; the others are computed in float32.
+                out (numpy.ndarray): The array of the rows of dtype into which the image is written;
+                    if None, a new array is created.
+        """
+        dtype = check_dtype(dtype)
+        shape = (stop - start, self.width) + (() if gray else (self.channels,))
+
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape or out.dtype != dtype:
+            raise ValueError(f'out must be an array of shape {shape} and dtype {dtype}.')
+
+        float_type = np.dtype(np.float64 if dtype.type is np.uint8 else np.float32)
+        rows = max(1, min(stop - start, CHUNK_BYTES // (self.width * float_type.itemsize)))
+        dist, color, rest = self.get_buffers(rows, float_type)
+
+        # The same arithmetic as get_distance.
+        x = ((np.arange(self.width) - self._center[0]) ** 2).astype(float_type)
+        scale = float_type.type(2 ** 0.5 * self.max_length / self.gradient_size)
+
+        for top in range(start, stop, rows):
+            bottom = min(top + rows, stop)
+            d, c, r = dist[:bottom - top], color[:bottom - top], rest[:bottom - top]
+            y = ((np.arange(top, bottom) - self._center[1]) ** 2).astype(float_type)
+
+            np.add(x, y[:, np.newaxis], out=d)
+            np.sqrt(d, out=d)
+            np.divide(d, scale, out=d)
+            np.minimum(d, 1, out=d)
+            rows_out = out[top - start:bottom - start]
+
+            for i in range(1 if gray or self.transparent else self.channels):
+                # outer_color * dist + inner_color * (1 - dist) without temporary arrays.
+                np.multiply(d, self.outer_color[i], out=c)
+                np.subtract(1, d, out=r)
+                np.multiply(r, self.inner_color[i], out=r)
+                np.add(c, r, out=c)
+                quantize(c, dtype, rows_out if gray else rows_out[:, :, i])
+
+            if self.transparent and not gray:
+                # The color channels are the same, and alpha is derived from them like expand.
+                expand_mask(rows_out[:, :, 0], self.channels, True, out=rows_out)
+
+        return out
+
+    def get_scaled(self, factor, pad=0):
+        """Return the generator whose image is this gradient sampled every factor pixels,
+           with pad samples added outside each edge; see lowres.
+        """
+        scaled = copy.copy(self)
+        scaled.height = get_sample_size(self.height, factor, pad)
+        scaled.width = get_sample_size(self.width, factor, pad)
+        # The center can be outside the samples, so that it is set bypassing the setters.
+        scaled._center = (self._center - get_sample_offset(factor, pad)) / factor
+        scaled.max_length = self.max_length / factor
+        scaled._lut = (None, None)
+        scaled._buffers = threading.local()
+        return scaled
+
+    def _prepare_batch(self, centers_h, centers_w, gradient_sizes, inner_colors, outer_colors):
+        shapes = [np.shape(v) for v in (centers_h, centers_w, gradient_sizes) if v is not None]
+        shapes += [np.shape(v)[:-1] for v in (inner_colors, outer_colors) if v is not None]
+        n = np.broadcast_shapes((1,), *shapes)[0]
+
+        def centers(values, size, default):
+            if values is None:
+                return np.full(n, default)
+            values = np.broadcast_to(np.asarray(values, dtype=np.float64), (n,))
+            # The same rule as the center_h and center_w setters.
+            return np.where((values >= 0) & (values <= size), values, size // 2)
+
+        def colors(values, default):
+            values = np.array(default) if values is None else np.asarray(values) / 255
+            return np.broadcast_to(values, (n, self.channels))
+
+        if gradient_sizes is None:
+            gradient_sizes = self.gradient_size
+
+        return (
+            n,
+            centers(centers_h, self.height, self._center[1]),
+            centers(centers_w, self.width, self._center[0]),
+            np.broadcast_to(np.asarray(gradient_sizes, dtype=np.float64), (n,)),
+            colors(inner_colors, self.inner_color),
+            colors(outer_colors, self.outer_color)
         )
-        arr = arr.reshape(self.height, self.width, self.channels)
+
+    def _iter_batch(self, batch, chunk_size):
+        n, ch, cw, sizes, inner, outer = batch
+        # The coordinate grids are shared by all of the masks.
+        y, x = np.ogrid[:self.height, :self.width]
+
+        for start in range(0, n, chunk_size):
+            sl = slice(start, start + chunk_size)
+            norm = ((x - cw[sl, None, None]) ** 2 + (y - ch[sl, None, None]) ** 2) ** 0.5
+            dist = norm / (2 ** 0.5 * self.max_length / sizes[sl, None, None])
+            np.minimum(dist, 1, out=dist)
+            dist = dist[..., np.newaxis]
+
+            yield outer[sl, None, None] * dist + inner[sl, None, None] * (1 - dist)
+
+    def iter_gradient_batch(self, centers_h=None, centers_w=None, gradient_sizes=None,
+                            inner_colors=None, outer_colors=None, chunk_size=64):
+        """Yield the gradients of many masks, which have the same height and width as this instance,
+           in arrays of shape (n, height, width, channels); n is chunk_size at most.
+            Args:
+                centers_h (array_like): y-axis centers; center_h of this instance, if not specified.
+                centers_w (array_like): x-axis centers; center_w of this instance, if not specified.
+                gradient_sizes (array_like): gradient_size of this instance, if not specified.
+                inner_colors (array_like):
+                    The shape must be (N, channels); values ranging from 0 to 255;
+                    inner_color of this instance, if not specified.
+                outer_colors (array_like):
+                    The shape must be (N, channels); values ranging from 0 to 255;
+                    outer_color of this instance, if not specified.
+                chunk_size (int): The maximum number of masks computed at once; default is 64.
+        """
+        batch = self._prepare_batch(centers_h, centers_w, gradient_sizes, inner_colors, outer_colors)
+        yield from self._iter_batch(batch, chunk_size)
+
+    def get_gradient_batch(self, centers_h=None, centers_w=None, gradient_sizes=None,
+                           inner_colors=None, outer_colors=None, chunk_size=64):
+        """Return the gradients of many masks stacked into an array of shape (N, height, width, channels).
+           See iter_gradient_batch about the arguments.
+        """
+        batch = self._prepare_batch(centers_h, centers_w, gradient_sizes, inner_colors, outer_colors)
+        arr = np.empty((batch[0], self.height, self.width, self.channels))
+
+        for start, chunk in zip(range(0, batch[0], chunk_size), self._iter_batch(batch, chunk_size)):
+            arr[start:start + len(chunk)] = chunk
+
         return arr
 
-    def output(self, arr, img_type, output_dir=None, with_suffix=True):
-        arr = np.clip(arr * 255, a_min=0, a_max=255).astype(np.uint8)
-        output_image(arr, img_type, output_dir, with_suffix)
+    def get_lut(self):
+        """Return the lookup table of shape (256, channels) from the levels of the distance field to the colors;
+           each level is given the color at the middle of the distances which fall into it.
+        """
+        key = (tuple(self.inner_color), tuple(self.outer_color))
+
+        if self._lut[0] != key:
+            dist = ((np.arange(256) + 0.5) / 255)[:, np.newaxis]
+            dist[-1] = 1
+            lut = self.to_image(np.array(self.outer_color) * dist + np.array(self.inner_color) * (1 - dist))
+            if self.transparent:
+                # Alpha is 255 minus the color, like expand.
+                invert_mask(lut[:, 0], out=lut[:, -1])
+            self._lut = (key, lut)
+
+        return self._lut[1]
+
+    @stage('gradient')
+    def get_frame(self, center_h=None, center_w=None, gray=False, out=None):
+        """Return the uint8 image of the gradient around the center, which is cut out of the distance field
+           precomputed for the height, width and gradient_size, and colored through a lookup table;
+           the cost is a slice and a table lookup. The centers are rounded to integers, and the image is
+           the same as the gradient computed at once for the default masks, otherwise it differs by 1 at most.
+            Args:
+                center_h (float): y-axis center; center_h of this instance, if not specified.
+                center_w (float): x-axis center; center_w of this instance, if not specified.
+                gray (bool): If True, only the first channel is returned in an array of shape (height, width).
+                out (numpy.ndarray): The uint8 array into which the image is written; if None, a new array is created.
+        """
+        field = get_distance_field(self.height, self.width, self.gradient_size)
+        lut = self.get_lut()
+
+        # The same rule as the center_h and center_w setters.
+        if center_h is None or not 0 <= center_h <= self.height:
+            center_h = self._center[1] if center_h is None else self.height // 2
+        if center_w is None or not 0 <= center_w <= self.width:
+            center_w = self._center[0] if center_w is None else self.width // 2
+
+        top = self.height - int(round(center_h))
+        left = self.width - int(round(center_w))
+        view = field[top:top + self.height, left:left + self.width]
+
+        if backends.get_backend() == 'numpy':
+            return np.take(lut[:, 0] if gray or self.channels == 1 else lut, view, axis=0, out=out)
+
+        if gray or self.channels == 1:
+            return cv2.LUT(view, np.ascontiguousarray(lut[:, 0]), dst=out)
+
+        return cv2.merge([cv2.LUT(view, np.ascontiguousarray(lut[:, i])) for i in range(self.channels)], dst=out)
+
+    def iter_frames(self, centers_h, centers_w, gray=False, out=None):
+        """Yield the frames of the gradient whose center moves along a path; see get_frame.
+            Args:
+                centers_h (array_like): y-axis centers of the frames.
+                centers_w (array_like): x-axis centers of the frames; the same length as centers_h.
+                gray (bool): If True, only the first channel is returned in arrays of shape (height, width).
+                out (numpy.ndarray):
+                    The array into which every frame is written; if specified, each frame must be used
+                    before the next one is yielded.
+        """
+        centers_h, centers_w = np.broadcast_arrays(np.asarray(centers_h, dtype=np.float64),
+                                                   np.asarray(centers_w, dtype=np.float64))
+
+        for center_h, center_w in zip(centers_h.ravel(), centers_w.ravel()):
+            yield self.get_frame(center_h, center_w, gray, out)
+
+    @stage('quantize')
+    def to_image(self, arr, dtype=np.uint8, out=None):
+        """Return the image of dtype quantized from a float gradient by quantize; arr is not changed.
+        """
+        return quantize(np.array(arr, dtype=np.float64), dtype, out)
+
+    def expand(self, mask, view=False, out=None):
+        """Expand a single-channel mask into the image of all channels;
+           the alpha channel of transparent classes is derived from the mask at the same time.
+        """
+        return expand_mask(mask, self.channels, self.transparent, view, out)
+
+    def output(self, arr, img_type, output_dir=None, with_suffix=True, dtype=np.uint8, encoder='png'):
+        arr = self.to_image(arr, dtype)
+        output_image(arr, img_type, output_dir, with_suffix, encoder)
+
+    @staticmethod
+    def create_image(inner_color, outer_color, height=256, width=256,
+                     gradient_size=2, center_h=None, center_w=None, workers=None,
+                     scale=1, interpolation='bilinear', dtype=np.uint8, out=None):
+        generator = RadialGradient(
+            inner_color=inner_color,
+            outer_color=outer_color,
+            height=height,
+            width=width,
+            gradient_size=gradient_size,
+            center_h=center_h,
+            center_w=center_w
+        )
+
+        return render_scaled(generator, scale, interpolation, workers, out=out, dtype=dtype)
 
     @staticmethod
     def output_image(inner_color, outer_color, height=256, width=256,
                      gradient_size=2, center_h=None, center_w=None,
-                     output_dir=None, with_suffix=True):
-        generator = RadialGradient(
+                     output_dir=None, with_suffix=True,
+                     *, workers=None, scale=1, interpolation='bilinear', dtype=np.uint8,
+                     encoder='png'):
+        arr = RadialGradient.create_image(
             inner_color=inner_color,
             outer_color=outer_color,
             height=height,
@@ -98,10 +426,12 @@ class RadialGradient:
             gradient_size=gradient_size,
             center_h=center_h,
             center_w=center_w,
+            workers=workers,
+            scale=scale,
+            interpolation=interpolation,
+            dtype=dtype
         )
-
-        arr = generator.get_gradient_array()
-        generator.output(arr, 'color_radial_gradient', output_dir, with_suffix)
+        output_image(arr, 'color_radial_gradient', output_dir, with_suffix, encoder)
 
 
 class RadialGradientMask(RadialGradient):
@@ -131,8 +461,9 @@ class RadialGradientMask(RadialGradient):
         )
 
     @staticmethod
-    def output_image(height=256, width=256, center_h=None, center_w=None,
-                     gradient_size=2, inner_to_outer=True, output_dir=None, with_suffix=True):
+    def create_image(height=256, width=256, center_h=None, center_w=None,
+                     gradient_size=2, inner_to_outer=True, gray=False, workers=None,
+                     scale=1, interpolation='bilinear', dtype=np.uint8, out=None):
         generator = RadialGradientMask(
             height=height,
             width=width,
@@ -142,8 +473,30 @@ class RadialGradientMask(RadialGradient):
             inner_to_outer=inner_to_outer
         )
 
-        arr = generator.get_gradient_array()
-        generator.output(arr, 'radial_gradient', output_dir, with_suffix)
+        # All channels are the same, so that only one is computed and expanded at last;
+        # with out, it is computed into the first channel of out and copied into the others.
+        mask = render_scaled(generator, scale, interpolation, workers,
+                             out=out if gray or out is None else out[..., 0], gray=True, dtype=dtype)
+        return mask if gray else generator.expand(mask, out=out)
+
+    @staticmethod
+    def output_image(height=256, width=256, center_h=None, center_w=None,
+                     gradient_size=2, inner_to_outer=True, output_dir=None, with_suffix=True,
+                     *, workers=None, scale=1, interpolation='bilinear', dtype=np.uint8,
+                     encoder='png'):
+        arr = RadialGradientMask.create_image(
+            height=height,
+            width=width,
+            center_h=center_h,
+            center_w=center_w,
+            gradient_size=gradient_size,
+            inner_to_outer=inner_to_outer,
+            workers=workers,
+            scale=scale,
+            interpolation=interpolation,
+            dtype=dtype
+        )
+        output_image(arr, 'radial_gradient', output_dir, with_suffix, encoder)
 
 
 class TransparentRadialGradientMask(RadialGradient):
@@ -160,6 +513,8 @@ class TransparentRadialGradientMask(RadialGradient):
                 from black to transparent white; if False, from the edges to center, it does.
     """
 
+    transparent = True
+
     def __init__(self, height=256, width=256, center_h=None, center_w=None,
                  gradient_size=2, inner_to_outer=True):
         super().__init__(
@@ -173,8 +528,9 @@ class TransparentRadialGradientMask(RadialGradient):
         )
 
     @staticmethod
-    def output_image(height=256, width=256, center_h=None, center_w=None,
-                     gradient_size=2, inner_to_outer=True, output_dir=None, with_suffix=True):
+    def create_image(height=256, width=256, center_h=None, center_w=None,
+                     gradient_size=2, inner_to_outer=True, gray=False, workers=None,
+                     scale=1, interpolation='bilinear', dtype=np.uint8, out=None):
         generator = TransparentRadialGradientMask(
             height=height,
             width=width,
@@ -184,8 +540,29 @@ class TransparentRadialGradientMask(RadialGradient):
             inner_to_outer=inner_to_outer
         )
 
-        arr = generator.get_gradient_array()
-        generator.output(arr, 'transparent_radial_gradient', output_dir, with_suffix)
+        # The color channels are the same, and alpha is derived from them while expanded.
+        mask = render_scaled(generator, scale, interpolation, workers,
+                             out=out if gray or out is None else out[..., 0], gray=True, dtype=dtype)
+        return mask if gray else generator.expand(mask, out=out)
+
+    @staticmethod
+    def output_image(height=256, width=256, center_h=None, center_w=None,
+                     gradient_size=2, inner_to_outer=True, output_dir=None, with_suffix=True,
+                     *, workers=None, scale=1, interpolation='bilinear', dtype=np.uint8,
+                     encoder='png'):
+        arr = TransparentRadialGradientMask.create_image(
+            height=height,
+            width=width,
+            center_h=center_h,
+            center_w=center_w,
+            gradient_size=gradient_size,
+            inner_to_outer=inner_to_outer,
+            workers=workers,
+            scale=scale,
+            interpolation=interpolation,
+            dtype=dtype
+        )
+        output_image(arr, 'transparent_radial_gradient', output_dir, with_suffix, encoder)
 
 
 # if __name__ == '__main__':
@@ -0,0 +1,45 @@
+from .linear_gradient_generator import (
+    LinearGradient,
+    HorizontalGradientMask,
+    TransparentHorizontalGradientMask,
+    VerticalGradientMask,
+    TransparentVerticalGradientMask
+)
+from .radial_gradient_generator import RadialGradient, RadialGradientMask, TransparentRadialGradientMask
+from .shapes.circle_generator import Circles, CircleMask, TransparentCircleMask
+from .shapes.line_generator import Lines, LineMask, TransparentLineMask
+
+
+GENERATORS = {
+    cls.__name__: cls for cls in (
+        LinearGradient,
+        HorizontalGradientMask,
+        TransparentHorizontalGradientMask,
+        VerticalGradientMask,
+        TransparentVerticalGradientMask,
+        RadialGradient,
+        RadialGradientMask,
+        TransparentRadialGradientMask,
+        Circles,
+        CircleMask,
+        TransparentCircleMask,
+        Lines,
+        LineMask,
+        TransparentLineMask
+    )
+}
+
+
+def get_generator(name):
+    """Return the generator class of the name, like 'RadialGradientMask'.
+    """
+    try:
+        return GENERATORS[name]
+    except KeyError:
+        raise ValueError(f'Unknown generator: {name}; choose from {", ".join(GENERATORS)}.') from None
+
+
+def create_image(name, params):
+    """Return the image which create_image of the generator class of the name creates.
+    """
+    return get_generator(name).create_image(**params)
@@ -0,0 +1,367 @@
+"""Serve the images of the generator classes over HTTP on a TCP port or a Unix socket.
+
+    python -m MaskImageGenerator.server --port 8000 -w 4
+    python -m MaskImageGenerator.server --unix /tmp/masks.sock
+
+    GET /masks/RadialGradientMask?height=512&width=512&gray=true
+    GET /masks/CircleMask?radius=80&format=raw
+    GET /masks/LineMask?coordinates=[[[0,0],[255,255]]]&format=npy
+    GET /generators
+    GET /stats
+
+The query parameters are the parameters of create_image, parsed as JSON if possible;
+format is 'png' (default), 'raw' or 'npy', and compression is the PNG compression from 0 to 9.
+The raw bytes of an image are returned with the X-Shape and X-Dtype headers.
+The images are generated and encoded on a worker pool and streamed back without touching disk;
+identical requests in flight are coalesced into one computation.
+"""
+import argparse
+import asyncio
+import inspect
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import numpy as np
+
+from .batch import parse_value
+from .cache import make_key
+from .registry import GENERATORS, get_generator
+from .utils import cv2, get_extension
+
+
+DEFAULT_PORT = 8000
+
+FORMATS = {
+    'png': 'image/png',
+    'raw': 'application/octet-stream',
+    'npy': 'application/x-npy',
+}
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+# The bytes written into a socket before waiting for it to be drained.
+STREAM_CHUNK = 2 ** 16
+
+# The seconds for which an idle connection is kept open.
+KEEP_ALIVE_SECONDS = 15
+
+# The number of the latest latencies from which the percentiles are computed.
+LATENCY_HISTORY = 1024
+
+
+def encode_image(img, fmt='png', compression=None):
+    """Return the encoded bytes of an image in memory.
+    """
+    match fmt:
+        case 'png':
+            # OpenCV would convert float images into uint8 silently.
+            get_extension(img, 'png')
+            params = [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, compression]
+            ok, buf = cv2.imencode('.png', img, params)
+            if not ok:
+                raise ValueError('Failed to encode the image into PNG.')
+            return buf
+        case 'raw':
+            return np.ascontiguousarray(img)
+        case 'npy':
+            f = io.BytesIO()
+            np.save(f, img)
+            # bytes, which can be returned from a process pool unlike a memoryview.
+            return f.getvalue()
+
+    raise ValueError(f'Unknown format: {fmt}; choose from {", ".join(FORMATS)}.')
+
+
+def render_image(name, params, fmt='png', compression=None, cache=None):
+    """Create the image of the generator class of the name, and return the encoded bytes,
+       the shape and the dtype of the image; run on the worker pool.
+       The errors which OpenCV raises for bad values of the parameters are raised as ValueError.
+    """
+    cls = get_generator(name)
+
+    try:
+        img = cls.create_image(**params) if cache is None else cache.get(cls, **params)
+        return encode_image(img, fmt, compression), img.shape, img.dtype.name
+    except Exception as e:
+        # cv2 is loaded if OpenCV raised the error.
+        if cv2.loaded and isinstance(e, cv2.error):
+            raise ValueError(str(e)) from None
+        raise
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class MaskServer:
+    """A class to serve the images of the generator classes with asyncio.
+        Args:
+            workers (int): The number of workers generating images; if None, the default of the executor.
+            processes (bool):
+                If True, images are generated on a process pool; otherwise on a thread pool,
+                on which NumPy and OpenCV release the GIL; default is False.
+            cache (cache.MaskCache):
+                If specified, the images are got from it; it can be used only on a thread pool.
+    """
+
+    def __init__(self, workers=None, processes=False, cache=None):
+        if processes and cache is not None:
+            raise ValueError('A cache cannot be shared with a process pool.')
+
+        self.cache = cache
+        self._executor = ProcessPoolExecutor(workers) if processes else ThreadPoolExecutor(workers)
+        self._inflight = {}
+        self._servers = []
+
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.computed = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self._latencies = deque(maxlen=LATENCY_HISTORY)
+
+    @property
+    def stats(self):
+        uptime = time.perf_counter() - self.started
+        latencies = np.array(self._latencies) if self._latencies else np.zeros(1)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+        stats = dict(
+            uptime_seconds=uptime,
+            requests=self.requests,
+            computed=self.computed,
+            coalesced=self.coalesced,
+            inflight=len(self._inflight),
+            errors=self.errors,
+            bytes_sent=self.bytes_sent,
+            requests_per_sec=self.requests / uptime,
+            mb_per_sec=self.bytes_sent / 1024 ** 2 / uptime,
+            mean_ms=self.total_seconds / self.requests * 1e3 if self.requests else 0.0,
+            p50_ms=p50 * 1e3,
+            p95_ms=p95 * 1e3,
+            p99_ms=p99 * 1e3,
+            max_ms=self.max_seconds * 1e3
+        )
+
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats
+
+        return stats
+
+    async def start(self, host='127.0.0.1', port=DEFAULT_PORT, unix=None):
+        """Start listening on the TCP port, or on the Unix socket of the path unix, and return the server.
+        """
+        if unix is not None:
+            server = await asyncio.start_unix_server(self.handle, unix)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+
+        self._servers.append(server)
+        return server
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+
+        self._servers.clear()
+        self._executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def get_image(self, name, params, fmt='png', compression=None):
+        """Return the result of render_image; identical requests in flight share one computation.
+        """
+        try:
+            cls = get_generator(name)
+        except ValueError as e:
+            raise HTTPError(404, str(e)) from None
+
+        if fmt not in FORMATS:
+            raise HTTPError(400, f'Unknown format: {fmt}; choose from {", ".join(FORMATS)}.')
+
+        try:
+            key = (make_key(cls, params), fmt, compression)
+        except TypeError as e:
+            raise HTTPError(400, str(e)) from None
+
+        if (future := self._inflight.get(key)) is not None:
+            self.coalesced += 1
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, render_image, name, params, fmt, compression, self.cache)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self.computed += 1
+
+        # A request which is cancelled, like by a closed connection, does not cancel the others.
+        try:
+            return await asyncio.shield(future)
+        except (TypeError, ValueError) as e:
+            raise HTTPError(400, str(e)) from None
+
+    async def route(self, method, target):
+        """Return the status, content type, body and extra headers of the response to a request.
+        """
+        if method != 'GET':
+            raise HTTPError(405, f'{method} is not allowed.')
+
+        url = urlsplit(target)
+        parts = [unquote(p) for p in url.path.split('/') if p]
+
+        match parts:
+            case ['generators']:
+                names = {name: list(inspect.signature(cls.create_image).parameters) for name, cls in GENERATORS.items()}
+                return 200, 'application/json', json.dumps(names).encode(), {}
+            case ['stats']:
+                return 200, 'application/json', json.dumps(self.stats).encode(), {}
+            case ['masks', name]:
+                params = {k: parse_value(v) for k, v in parse_qsl(url.query)}
+                fmt = params.pop('format', 'png')
+                compression = params.pop('compression', None)
+                body, shape, dtype = await self.get_image(name, params, fmt, compression)
+                headers = {'X-Shape': ','.join(map(str, shape)), 'X-Dtype': dtype}
+                return 200, FORMATS[fmt], body, headers
+
+        raise HTTPError(404, f'{url.path} is not found.')
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    break
+
+                if not line.strip():
+                    break
+
+                start = time.perf_counter()
+                method, target, version = line.decode('latin-1').split()
+                headers = await self.read_headers(reader)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                try:
+                    status, content_type, body, extra = await self.route(method, target)
+                except HTTPError as e:
+                    status, content_type, body, extra = e.status, 'text/plain', str(e).encode(), {}
+                except Exception as e:
+                    status, content_type, body, extra = 500, 'text/plain', repr(e).encode(), {}
+
+                nbytes = await self.send(writer, status, content_type, body, extra, keep_alive)
+                self.record(status, nbytes, time.perf_counter() - start)
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_headers(self, reader):
+        headers = {}
+
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        return headers
+
+    async def send(self, writer, status, content_type, body, headers, keep_alive=True):
+        view = memoryview(body).cast('B')
+        head = [
+            f'HTTP/1.1 {status} {REASONS[status]}',
+            f'Content-Type: {content_type}',
+            f'Content-Length: {view.nbytes}',
+            f'Connection: {"keep-alive" if keep_alive else "close"}'
+        ]
+        head += [f'{k}: {v}' for k, v in headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+        for i in range(0, view.nbytes, STREAM_CHUNK):
+            writer.write(view[i:i + STREAM_CHUNK])
+            await writer.drain()
+
+        await writer.drain()
+        return view.nbytes
+
+    def record(self, status, nbytes, seconds):
+        self.requests += 1
+        self.bytes_sent += nbytes
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self._latencies.append(seconds)
+
+        if status >= 400:
+            self.errors += 1
+
+
+async def fetch(target, host='127.0.0.1', port=DEFAULT_PORT, unix=None):
+    """Send a GET request to a MaskServer and return the status, the headers and the body.
+       An image of format 'raw' is decoded by decode_raw.
+    """
+    if unix is not None:
+        reader, writer = await asyncio.open_unix_connection(unix)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    try:
+        writer.write(f'GET {target} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n'.encode('latin-1'))
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        body = await reader.readexactly(int(headers['content-length']))
+    finally:
+        writer.close()
+
+    return status, headers, body
+
+
+def decode_raw(headers, body):
+    shape = tuple(int(v) for v in headers['x-shape'].split(','))
+    return np.frombuffer(body, dtype=headers['x-dtype']).reshape(shape)
+
+
+async def serve(host='127.0.0.1', port=DEFAULT_PORT, unix=None, workers=None, processes=False):
+    async with MaskServer(workers, processes) as server:
+        listener = await server.start(host, port, unix)
+        print(f'serving on {unix or f"http://{host}:{port}"}', flush=True)
+        await listener.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the images of the generator classes over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1', help='The host to listen on.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='The TCP port to listen on.')
+    parser.add_argument('--unix', help='The path of a Unix socket to listen on instead of the TCP port.')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='The number of workers generating images.')
+    parser.add_argument('--processes', action='store_true', help='Generate images on a process pool.')
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.processes))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""The backends which draw and blur shapes.
+
+'opencv' draws and blurs with OpenCV. 'numpy' needs only NumPy: circles and lines are rasterized
+from the distance to them with anti-aliasing, and the images are blurred by separable filters.
+"""
+import functools
+import importlib.util
+
+import numpy as np
+
+
+BACKENDS = ('opencv', 'numpy')
+
+# The backend set by set_backend; if None, 'opencv' if it is installed, otherwise 'numpy'.
+_backend = None
+
+# The bytes of a float32 chunk filtered at once, which is small enough to stay in the cache.
+FILTER_CHUNK_BYTES = 2 ** 18
+
+
+@functools.cache
+def has_opencv():
+    # find_spec does not import the module.
+    try:
+        return importlib.util.find_spec('cv2') is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def set_backend(name):
+    """Set the backend of the shape classes whose backend attribute is None, and return the previous one.
+        Args:
+            name (str): 'opencv' or 'numpy'; if None, 'opencv' if it is installed, otherwise 'numpy'.
+    """
+    global _backend
+
+    if name is not None and name not in BACKENDS:
+        raise ValueError(f'Unknown backend: {name}; choose from {", ".join(BACKENDS)}.')
+
+    previous, _backend = _backend, name
+    return previous
+
+
+def get_backend():
+    if _backend is not None:
+        return _backend
+    return 'opencv' if has_opencv() else 'numpy'
+
+
+def to_uint8(arr):
+    return np.clip(np.rint(arr), 0, 255).astype(np.uint8)
+
+
+def gaussian_kernel(ksize, sigma):
+    """Return the 1D Gaussian weights which cv2.getGaussianKernel returns for ksize larger than 7.
+    """
+    x = np.arange(ksize) - (ksize - 1) / 2
+    weights = np.exp(-x ** 2 / (2 * sigma ** 2))
+    return (weights / weights.sum()).astype(np.float32)
+
+
+def filter_rows(src, weights):
+    """Convolve every row of a float32 2D array with the odd number of symmetric weights;
+       the borders are reflected like cv2.BORDER_REFLECT_101.
+    """
+    height, width = src.shape
+    half = len(weights) // 2
+    out = np.empty_like(src)
+    chunk = max(1, FILTER_CHUNK_BYTES // ((width + 2 * half) * 4))
+    tmp = np.empty((chunk, width), dtype=np.float32)
+
+    for start in range(0, height, chunk):
+        padded = np.pad(src[start:start + chunk], ((0, 0), (half, half)), mode='reflect')
+        acc = out[start:start + chunk]
+        t = tmp[:len(acc)]
+        np.multiply(padded[:, half:half + width], weights[half], out=acc)
+
+        # The weights are symmetric, so that a pair of taps is added before multiplied.
+        for i in range(half):
+            np.add(padded[:, i:i + width], padded[:, 2 * half - i:2 * half - i + width], out=t)
+            t *= weights[i]
+            acc += t
+
+    return out
+
+
+def filter_cols(src, weights):
+    """Convolve every column of a float32 2D array like filter_rows.
+    """
+    height, width = src.shape
+    half = len(weights) // 2
+    padded = np.pad(src, ((half, half), (0, 0)), mode='reflect')
+    out = np.empty_like(src)
+    chunk = max(1, FILTER_CHUNK_BYTES // (width * 4))
+    tmp = np.empty((chunk, width), dtype=np.float32)
+
+    for start in range(0, height, chunk):
+        acc = out[start:start + chunk]
+        rows = len(acc)
+        t = tmp[:rows]
+        np.multiply(padded[start + half:start + half + rows], weights[half], out=acc)
+
+        for i in range(half):
+            np.add(padded[start + i:start + i + rows], padded[start + 2 * half - i:start + 2 * half - i + rows], out=t)
+            t *= weights[i]
+            acc += t
+
+    return out
+
+
+def gaussian_blur(img, ksize, sigma):
+    """Blur a 2D image by the separable Gaussian like cv2.GaussianBlur; the values differ by 1 at most.
+    """
+    weights = gaussian_kernel(ksize, sigma)
+    arr = filter_cols(filter_rows(img.astype(np.float32), weights), weights)
+    return to_uint8(arr) if img.dtype == np.uint8 else arr
+
+
+def box_filter(arr, size, axis):
+    """Return the means of size values along the axis from the running sums, like cv2.blur.
+    """
+    half = size // 2
+    pad = [(0, 0)] * arr.ndim
+    pad[axis] = (half + 1, half)
+    sums = np.cumsum(np.pad(arr, pad, mode='reflect'), axis=axis, dtype=np.float64)
+    upper = [slice(None)] * arr.ndim
+    lower = [slice(None)] * arr.ndim
+    upper[axis] = slice(size, None)
+    lower[axis] = slice(0, arr.shape[axis])
+    out = np.subtract(sums[tuple(upper)], sums[tuple(lower)], dtype=np.float32)
+    out /= size
+    return out
+
+
+def box_blur(img, sizes):
+    """Blur a 2D image by the box filters of the sizes repeatedly.
+    """
+    arr = img.astype(np.float32)
+
+    for size in sizes:
+        arr = box_filter(box_filter(arr, size, 1), size, 0)
+
+    return to_uint8(arr) if img.dtype == np.uint8 else arr
+
+
+def resize_area(img, factor):
+    """Downsample a 2D image by the integer factor, averaging factor x factor pixels
+       like cv2.INTER_AREA; the edges are repeated to a multiple of factor.
+    """
+    height, width = img.shape
+    small_h, small_w = -(-height // factor), -(-width // factor)
+    padded = np.pad(img.astype(np.float32), ((0, small_h * factor - height), (0, small_w * factor - width)), mode='edge')
+    return padded.reshape(small_h, factor, small_w, factor).mean(axis=(1, 3))
+
+
+def resize_linear(img, factor, height, width):
+    """Upsample a 2D image by the integer factor to height x width, which can be smaller than factor times
+       the size because of the edges added by resize_area, by bilinear interpolation with the pixel centers
+       aligned like cv2.INTER_LINEAR.
+    """
+    def coords(n, size):
+        x = np.clip((np.arange(n) + 0.5) / factor - 0.5, 0, size - 1)
+        i = np.minimum(x.astype(np.int64), size - 2) if size > 1 else np.zeros(n, dtype=np.int64)
+        return i, (x - i).astype(np.float32)
+
+    y0, fy = coords(height, img.shape[0])
+    x0, fx = coords(width, img.shape[1])
+    y1, x1 = np.minimum(y0 + 1, img.shape[0] - 1), np.minimum(x0 + 1, img.shape[1] - 1)
+
+    rows = img[y0] * (1 - fy[:, np.newaxis]) + img[y1] * fy[:, np.newaxis]
+    return rows[:, x0] * (1 - fx) + rows[:, x1] * fx
+
+
+def pyramid_blur(img, factor, sigma):
+    """Downsample a 2D image by factor, blur it by the Gaussian of sigma, and upsample it.
+    """
+    small = resize_area(img, factor)
+    ksize = 2 * int(np.ceil(3 * sigma)) + 1
+    weights = gaussian_kernel(ksize, sigma)
+    small = filter_cols(filter_rows(small, weights), weights)
+    arr = resize_linear(small, factor, *img.shape)
+    return to_uint8(arr) if img.dtype == np.uint8 else arr
+
+
+def draw_circle(img, center, radius, color, thickness=-1):
+    """Draw an anti-aliased circle from the distance to its edge; the widths are matched to cv2.circle
+       with cv2.LINE_AA, and the images blurred by cv2.GaussianBlur differ by 4 at most.
+    """
+    x, y = center
+    height, width = img.shape[:2]
+
+    # The coverage falls from 1 to 0 between edge - 0.5 and edge + 0.5 from the center or the ring.
+    if thickness < 0:
+        edge = radius + 0.6
+        extent = edge + 1
+    else:
+        edge = (thickness + 1) // 2 + 0.7 if thickness > 1 else 0.65
+        extent = radius + edge + 1
+
+    top, bottom = max(0, int(y - extent)), min(height, int(np.ceil(y + extent)) + 1)
+    left, right = max(0, int(x - extent)), min(width, int(np.ceil(x + extent)) + 1)
+
+    if top >= bottom or left >= right:
+        return
+
+    py, px = np.ogrid[top:bottom, left:right]
+    dist = np.hypot(px - x, py - y, dtype=np.float32)
+
+    if thickness >= 0:
+        dist = np.abs(dist - radius)
+
+    cov = np.clip(edge + 0.5 - dist, 0, 1)
+    color = np.asarray(color, dtype=np.float32)
+
+    if img.ndim == 2:
+        color = color[0]
+    else:
+        color = color[:img.shape[2]]
+        cov = cov[:, :, np.newaxis]
+
+    box = img[top:bottom, left:right]
+    box[:] = np.floor(box + (color - box) * cov + 0.5)
@@ -1,14 +1,64 @@
-import cv2
+import numpy as np
 
-from .shape_mask import ShapeMask
-from ..utils import output_image
+from . import backends
+from .shape_mask import ShapeMask, gaussian_sigma
+from ..instrument import stage
+from ..utils import cv2, output_image
+
+
+# The smallest kernel with which create_image draws soft circles analytically.
+SOFT_MIN_KERNEL = 31
+
+# The smallest radius of the rings which create_image draws analytically; the rings of cv2.circle are wider
+# than thickness by about 8 / radius, as the anti-aliased edges of its short segments overlap.
+SOFT_MIN_RING_RADIUS = 50
+
+
+def gaussian_cdf(x):
+    """Return the standard normal cumulative distribution function of x;
+       erf is approximated by Abramowitz and Stegun 7.1.26, whose error is less than 1.5e-7.
+    """
+    z = np.abs(x) / 2 ** 0.5
+    t = 1 / (1 + 0.3275911 * z)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    erf = 1 - poly * np.exp(-z * z)
+    return 0.5 * (1 + np.copysign(erf, x))
+
+
+def blurred_disk(dist, radius, sigma):
+    """Return the coverage of a disk of radius blurred by the Gaussian of sigma at the distances from its center.
+       The edge is a Gaussian CDF moved inward by sigma ** 2 / (2 * radius), where the curved edge of the blurred disk
+       is half covered.
+    """
+    if radius <= 0:
+        return np.zeros_like(dist)
+    return gaussian_cdf((radius - sigma ** 2 / (2 * radius) - dist) / sigma)
+
+
+def get_polygon_step(radius):
+    """Return the angle in radians between the vertices of the polygon which cv2.circle draws for radius.
+    """
+    return np.deg2rad(90 if radius < 3 else 30 if radius < 10 else 18 if radius < 15 else 5)
+
+
+def use_soft_edges(radius, thickness, kernel):
+    """Return whether the soft edges of a circle are close to the blurred one; the kernel must be SOFT_MIN_KERNEL
+       at least, the inner edge must be 3 sigma away from the center, and the radius of a ring must be
+       SOFT_MIN_RING_RADIUS at least. Otherwise create_image blurs the circle.
+    """
+    if thickness >= 0 and radius < SOFT_MIN_RING_RADIUS:
+        return False
+
+    inner = radius if thickness < 0 else radius - max(thickness, 1) / 2
+    return kernel >= SOFT_MIN_KERNEL and inner >= 3 * gaussian_sigma(kernel)
 
 
 class Circles(ShapeMask):
     """A class to draw a circle on an image.
     """
 
-    def create_circle(self, img, color, radius, thickness=-1, center=None):
+    @stage('draw')
+    def create_circle(self, img, color, radius, thickness=-1, center=None, offset=0):
         """Draw a circle.
             Args:
                 img (numpy.ndarray): The image onto which circle is drawn.
@@ -18,25 +68,109 @@ class Circles(ShapeMask):
                 center (tuple): Specify the center coordinates as a tuple (x, y);
                                 the coordinate values must be integers; if None is specified,
                                 the center is (width / 2, height / 2); default is None.
+                offset (int): The row of the whole image which the first row of img is; default is 0.
         """
         if center is None:
             center = (int(self.width / 2), int(self.height / 2))
 
-        cv2.circle(img, center, radius, color, thickness, cv2.LINE_AA)
+        if offset:
+            center = (center[0], center[1] - offset)
+
+        if self.get_backend() == 'numpy':
+            backends.draw_circle(img, center, radius, color, thickness)
+        else:
+            cv2.circle(img, center, radius, color, thickness, cv2.LINE_AA)
+
+    @stage('draw')
+    def create_soft_circles(self, img, color, circles, feather, thickness=-1, offset=0):
+        """Draw circles with soft edges, which look like the circles blurred by cv2.GaussianBlur
+           with the kernel size of feather. The falloff is computed from the distance to the edges
+           only in the bounding boxes of the circles, so that the cost does not depend on feather;
+           with the 'opencv' backend, the edges are those of the polygon which cv2.circle draws.
+           Against the circles drawn by the backend and blurred, the maximum errors measured with feather
+           from 31 to 101, radii from 3 sigma to 700, thickness up to 33 and rings of radius 50 or larger are
+           5 for filled circles and 6 for rings with 'opencv', and 3 and 4 with 'numpy';
+           they grow to tens with smaller feathers or radii, where use_soft_edges is False.
+            Args:
+                img (numpy.ndarray): The image onto which circles are drawn.
+                color (tuple or list): The color of the circles.
+                circles (array_like): The shape must be (N, 3); each row is (x, y, radius) of a circle.
+                feather (int): The Gaussian kernel size which the soft edges imitate.
+                thickness (int): Line thickness; Setting a negative value draws filled circles; default is -1.
+                offset (int): The row of the whole image which the first row of img is; default is 0.
+        """
+        # The blur of the anti-aliased edge of cv2.circle is added to the Gaussian.
+        sigma = np.hypot(gaussian_sigma(feather), 0.5)
+        color = np.asarray(color, dtype=np.float32)
+
+        # A single-channel image is drawn with the first value of the color.
+        if img.ndim == 2:
+            color = color[0]
+        height, width = img.shape[:2]
+        polygon = self.get_backend() != 'numpy'
+
+        for x, y, radius in np.asarray(circles, dtype=np.float64).reshape(-1, 3):
+            y -= offset
+            extent = radius + max(thickness, 0) / 2 + 2 + 4 * sigma
+            top, bottom = max(0, int(y - extent)), min(height, int(np.ceil(y + extent)) + 1)
+            left, right = max(0, int(x - extent)), min(width, int(np.ceil(x + extent)) + 1)
+
+            if top >= bottom or left >= right:
+                continue
+
+            py, px = np.ogrid[top:bottom, left:right]
+            dist = np.hypot(px - x, py - y, dtype=np.float32)
+
+            if polygon:
+                # cv2.circle draws a polygon, whose edges are inside the circle between the vertices;
+                # the distance is measured from the nearest edge, and moved so that the vertices are at radius.
+                step = get_polygon_step(radius)
+                angle = np.mod(np.arctan2(py - y, px - x, dtype=np.float32), step) - step / 2
+                dist = dist * np.cos(angle) + np.float32(radius * (1 - np.cos(step / 2)))
+
+            if thickness < 0:
+                # The edge of cv2.circle with cv2.LINE_AA is about 0.6 outside radius, like backends.draw_circle.
+                cov = blurred_disk(dist, radius + 0.6, sigma)
+            else:
+                # A blurred ring is the difference of two disks;
+                # the anti-aliased lines of OpenCV are wider than thickness.
+                half = (thickness + 1) // 2 + 0.7 if thickness > 1 else 0.65
+                cov = blurred_disk(dist, radius + half, sigma) - blurred_disk(dist, radius - half, sigma)
+
+            if img.ndim == 3:
+                cov = cov[:, :, np.newaxis]
+
+            box = img[top:bottom, left:right]
+            box[:] = np.floor(box + (color - box) * cov + 0.5)
 
     @staticmethod
-    def output_image(bg_color, circlr_color, height=256, width=256, radius=50,
-                     thickness=-1, circle_center=None, gaussian_kernel=None,
-                     output_dir=None, with_suffix=True):
+    def create_image(bg_color, circlr_color, height=256, width=256, radius=50,
+                     thickness=-1, circle_center=None, gaussian_kernel=None, soft=False, blur_method='exact',
+                     workers=None, scale=1, interpolation='bilinear'):
         generator = Circles(bg_color, height, width)
         img = generator.create_bg_image()
-        generator.create_circle(img, circlr_color, radius, thickness, circle_center)
 
-        if gaussian_kernel is not None:
-            img = generator.blur(img, gaussian_kernel)
+        if soft and gaussian_kernel is not None and use_soft_edges(radius, thickness, gaussian_kernel):
+            x, y = (width // 2, height // 2) if circle_center is None else circle_center
+            generator.create_soft_circles(img, circlr_color, [(x, y, radius)], gaussian_kernel, thickness)
+        else:
+            generator.create_circle(img, circlr_color, radius, thickness, circle_center)
+
+            if gaussian_kernel is not None:
+                img = generator.blur_image(img, gaussian_kernel, blur_method, workers, scale, interpolation)
 
         # change rgb to bgr.
         img = generator.change_rgb_to_bgr(img)
+        return img
+
+    @staticmethod
+    def output_image(bg_color, circlr_color, height=256, width=256, radius=50,
+                     thickness=-1, circle_center=None, gaussian_kernel=None,
+                     output_dir=None, with_suffix=True, *, soft=False, blur_method='exact',
+                     workers=None, scale=1, interpolation='bilinear'):
+        img = Circles.create_image(
+            bg_color, circlr_color, height, width, radius, thickness, circle_center, gaussian_kernel,
+            soft, blur_method, workers=workers, scale=scale, interpolation=interpolation)
         output_image(img, 'circle', output_dir, with_suffix)
 
 
@@ -59,20 +193,39 @@ class CircleMask(Circles):
 
         self.circle_color = (255, 255, 255) if white_circle else (0, 0, 0)
 
-    def create_circle(self, img, radius, thickness=-1, center=None):
-        super().create_circle(img, self.circle_color, radius, thickness, center)
+    def create_circle(self, img, radius, thickness=-1, center=None, offset=0):
+        super().create_circle(img, self.circle_color, radius, thickness, center, offset)
+
+    def create_soft_circles(self, img, circles, feather, thickness=-1, offset=0):
+        super().create_soft_circles(img, self.circle_color, circles, feather, thickness, offset)
 
     @staticmethod
-    def output_image(height=256, width=256, radius=50, thickness=-1,
-                     circle_center=None, gaussian_kernel=51, white_circle=True,
-                     output_dir=None, with_suffix=True):
+    def create_image(height=256, width=256, radius=50, thickness=-1,
+                     circle_center=None, gaussian_kernel=51, white_circle=True, soft=False, blur_method='exact',
+                     gray=False, workers=None, scale=1, interpolation='bilinear'):
         generator = CircleMask(height, width, white_circle)
-        img = generator.create_bg_image()
-        generator.create_circle(img, radius, thickness, circle_center)
+        img = generator.create_bg_image(gray=True)
 
-        if gaussian_kernel is not None:
-            img = generator.blur(img, gaussian_kernel)
+        if soft and gaussian_kernel is not None and use_soft_edges(radius, thickness, gaussian_kernel):
+            x, y = (width // 2, height // 2) if circle_center is None else circle_center
+            generator.create_soft_circles(img, [(x, y, radius)], gaussian_kernel, thickness)
+        else:
+            generator.create_circle(img, radius, thickness, circle_center)
 
+            if gaussian_kernel is not None:
+                img = generator.blur_image(img, gaussian_kernel, blur_method, workers, scale, interpolation)
+
+        # The mask is drawn and blurred in a single channel, which is expanded at last.
+        return img if gray else generator.expand(img)
+
+    @staticmethod
+    def output_image(height=256, width=256, radius=50, thickness=-1,
+                     circle_center=None, gaussian_kernel=51, white_circle=True,
+                     output_dir=None, with_suffix=True, *, soft=False, blur_method='exact',
+                     workers=None, scale=1, interpolation='bilinear'):
+        img = CircleMask.create_image(
+            height, width, radius, thickness, circle_center, gaussian_kernel, white_circle,
+            soft, blur_method, workers=workers, scale=scale, interpolation=interpolation)
         output_image(img, 'circle_mask', output_dir, with_suffix)
 
 
@@ -86,6 +239,8 @@ class TransparentCircleMask(Circles):
                 when False is specified, the background is white and the circle is black; default is True.
     """
 
+    transparent = True
+
     def __init__(self, height=256, width=256, white_circle=True):
         super().__init__(
             bg_color=(0, 0, 0, 255) if white_circle else (255, 255, 255, 255),
@@ -95,19 +250,44 @@ class TransparentCircleMask(Circles):
 
         self.circle_color = (255, 255, 255, 255) if white_circle else (0, 0, 0, 255)
 
-    def create_circle(self, img, radius, thickness=-1, center=None):
-        super().create_circle(img, self.circle_color, radius, thickness, center)
-        img[:, :, 3] -= img[:, :, 0]
+    def create_circle(self, img, radius, thickness=-1, center=None, offset=0):
+        super().create_circle(img, self.circle_color, radius, thickness, center, offset)
+
+        # The alpha channel of a single-channel image is derived by expand.
+        if img.ndim == 3:
+            self.make_transparent(img)
+
+    def create_soft_circles(self, img, circles, feather, thickness=-1, offset=0):
+        super().create_soft_circles(img, self.circle_color, circles, feather, thickness, offset)
+
+        if img.ndim == 3:
+            self.make_transparent(img)
 
     @staticmethod
-    def output_image(height=256, width=256, radius=50, thickness=-1, circle_center=None,
-                     gaussian_kernel=51, white_circle=True,
-                     output_dir=None, with_suffix=True):
+    def create_image(height=256, width=256, radius=50, thickness=-1, circle_center=None,
+                     gaussian_kernel=51, white_circle=True, soft=False, blur_method='exact', gray=False,
+                     workers=None, scale=1, interpolation='bilinear'):
         generator = TransparentCircleMask(height, width, white_circle)
-        img = generator.create_bg_image()
-        generator.create_circle(img, radius, thickness, circle_center)
+        img = generator.create_bg_image(gray=True)
+
+        if soft and gaussian_kernel is not None and use_soft_edges(radius, thickness, gaussian_kernel):
+            x, y = (width // 2, height // 2) if circle_center is None else circle_center
+            generator.create_soft_circles(img, [(x, y, radius)], gaussian_kernel, thickness)
+        else:
+            generator.create_circle(img, radius, thickness, circle_center)
+
+            if gaussian_kernel is not None:
+                img = generator.blur_image(img, gaussian_kernel, blur_method, workers, scale, interpolation)
 
-        if gaussian_kernel is not None:
-            img = generator.blur(img, gaussian_kernel)
+        # The mask is drawn and blurred in a single channel, which is expanded at last.
+        return img if gray else generator.expand(img)
 
+    @staticmethod
+    def output_image(height=256, width=256, radius=50, thickness=-1, circle_center=None,
+                     gaussian_kernel=51, white_circle=True,
+                     output_dir=None, with_suffix=True, *, soft=False, blur_method='exact',
+                     workers=None, scale=1, interpolation='bilinear'):
+        img = TransparentCircleMask.create_image(
+            height, width, radius, thickness, circle_center, gaussian_kernel, white_circle,
+            soft, blur_method, workers=workers, scale=scale, interpolation=interpolation)
         output_image(img, 'trans_circle_mask', output_dir, with_suffix)
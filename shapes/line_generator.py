@@ -1,42 +1,204 @@
-import cv2
+import numpy as np
 
 from .shape_mask import ShapeMask
-from ..utils import output_image
+from ..instrument import stage
+from ..utils import cv2, output_image
+
+
+# The number of lines from which they are drawn with cv2.polylines.
+BULK_LINES = 64
+# The number of lines passed to cv2.polylines at once.
+POLYLINES_BATCH = 4096
+# The number of rows of the bands rasterized by the 'sdf' method.
+SDF_TILE = 64
+# The maximum number of pixel-segment distances computed at once by the 'sdf' method.
+SDF_CHUNK = 2 ** 20
+# The rows beyond thickness // 2 which the anti-aliased lines of OpenCV can reach.
+AA_MARGIN = 2
 
 
 class Lines(ShapeMask):
     """A class to draw lines on an image.
     """
 
-    def create_lines(self, img, coordinates, color, thickness=5):
+    @stage('draw')
+    def create_lines(self, img, coordinates, color, thickness=5, offset=0, method=None):
         """Draw lines on an image.
             Args:
                 img (numpy.ndarray): The image onto which lines are drawn.
-                coodinates (list):
-                    The elements are tuples or lists containing the start and end points of the line like below.
+                coodinates (list or numpy.ndarray):
+                    The elements are tuples or lists containing the start and end points of the line like below,
+                    or an array of shape (N, 2, 2).
                     [[(0, 0), (256, 256)], [(0, 128), (256, 128)], [(128, 0), (128, 256)], [(0, 256), (256, 0)]]
                 color (tuple or list): Line color.
                 thickness (int) Line thickness.
+                offset (int): The row of the whole image which the first row of img is; default is 0.
+                method (str):
+                    'cv2' draws lines with OpenCV; many lines are drawn with cv2.polylines in batches,
+                    which gives the same image as drawing them one by one. OpenCV moves the ends of
+                    the lines which it clips at the edges of img, so that the lines crossing a part of
+                    the whole image, like a strip of get_strip, are drawn on a canvas covering all of
+                    their rows, which can be as large as the whole image.
+                    'sdf' rasterizes lines from the distance to them with analytic anti-aliasing, band by band,
+                    which does not depend on offset and needs only NumPy;
+                    if None, 'sdf' for the 'numpy' backend, otherwise 'cv2'.
+        """
+        if method is None:
+            method = 'sdf' if self.get_backend() == 'numpy' else 'cv2'
+
+        if method == 'sdf':
+            self.rasterize_lines(img, coordinates, color, thickness, offset)
+            return
+
+        if offset or len(img) < self.height:
+            self.draw_lines_on_canvas(img, coordinates, color, thickness, offset)
+            return
+
+        self.draw_lines(img, coordinates, color, thickness, offset)
+
+    def draw_lines_on_canvas(self, img, coordinates, color, thickness=5, offset=0):
+        """Draw the lines crossing img, a part of the whole image, on a canvas covering all rows of them
+           within the whole image, so that OpenCV clips them only where it clips them in the whole image.
         """
+        pts = np.asarray(coordinates, dtype=np.int64).reshape(-1, 2, 2)
+        reach = thickness // 2 + AA_MARGIN
+        lo = np.clip(pts[:, :, 1].min(axis=1) - reach, 0, self.height)
+        hi = np.clip(pts[:, :, 1].max(axis=1) + reach + 1, 0, self.height)
+        crossing = (lo < offset + len(img)) & (hi > offset)
+
+        if not crossing.any():
+            return
+
+        top = min(offset, lo[crossing].min())
+        bottom = max(offset + len(img), hi[crossing].max())
+        # The rows out of img are only drawn over and cut off.
+        canvas = np.zeros((bottom - top,) + img.shape[1:], dtype=img.dtype)
+        canvas[offset - top:offset - top + len(img)] = img
+
+        self.draw_lines(canvas, pts[crossing], color, thickness, top)
+        img[:] = canvas[offset - top:offset - top + len(img)]
+
+    def draw_lines(self, img, coordinates, color, thickness=5, offset=0):
+        if isinstance(coordinates, np.ndarray) or len(coordinates) >= BULK_LINES:
+            self.draw_polylines(img, coordinates, color, thickness, offset)
+            return
 
         for start_pt, end_pt in coordinates:
+            if offset:
+                start_pt = (start_pt[0], start_pt[1] - offset)
+                end_pt = (end_pt[0], end_pt[1] - offset)
+
             cv2.line(
                 img, start_pt, end_pt, color, thickness=thickness, lineType=cv2.LINE_AA
             )
 
+    def draw_polylines(self, img, coordinates, color, thickness=5, offset=0):
+        pts = np.asarray(coordinates, dtype=np.int32).reshape(-1, 2, 2)
+
+        if offset:
+            pts = pts - np.array([0, offset], dtype=np.int32)
+
+        for i in range(0, len(pts), POLYLINES_BATCH):
+            cv2.polylines(img, list(pts[i:i + POLYLINES_BATCH]), False, color, thickness, cv2.LINE_AA)
+
+    def rasterize_lines(self, img, coordinates, color, thickness=5, offset=0):
+        # The coverage of a pixel falls from 1 to 0 between reach - 1 and reach from the line;
+        # reach is matched to the anti-aliased lines of OpenCV, which are wider than thickness.
+        reach = (thickness + 1) // 2 + 1.2 if thickness > 1 else 1.2
+        pieces = self.split_lines(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2, 2), 2 * reach)
+
+        # Every piece is evaluated only in a box of box_size x box_size pixels around it.
+        corner = np.floor(pieces.min(axis=1) - reach).astype(np.int64)
+        box_size = int(np.ceil(np.abs(pieces[:, 1] - pieces[:, 0]).max(initial=0) + 2 * reach)) + 2
+        order = np.argsort(corner[:, 1], kind='stable')
+        pieces, corner = pieces[order], corner[order]
+
+        grid = np.arange(box_size)
+        step = max(1, SDF_CHUNK // box_size ** 2)
+        color = np.asarray(color, dtype=np.float64)
+        height, width = img.shape[:2]
+
+        # A single-channel image is drawn with the first value of the color.
+        if img.ndim == 2:
+            color = color[0]
+
+        for top in range(0, height, SDF_TILE):
+            band = img[top:top + SDF_TILE]
+            # The rows of the whole image, so that the result does not depend on the offset.
+            g_top = top + offset
+            g_bottom = g_top + len(band)
+            lo, hi = np.searchsorted(corner[:, 1], [g_top - box_size, g_bottom])
+
+            if lo == hi:
+                continue
+
+            cov = np.zeros(band.shape[:2])
+
+            for i in range(lo, hi, step):
+                seg = pieces[i:min(i + step, hi)]
+                gx = corner[i:i + len(seg), 0, None, None] + grid[None, None, :]
+                gy = corner[i:i + len(seg), 1, None, None] + grid[None, :, None]
+                vals = self.get_coverage(gx, gy, seg, reach)
+
+                valid = (vals > 0) & (gy >= g_top) & (gy < g_bottom) & (gx >= 0) & (gx < width)
+                gx, gy = np.broadcast_arrays(gx, gy)
+                np.maximum.at(cov, (gy[valid] - g_top, gx[valid]), vals[valid])
+
+            rows, cols = np.nonzero(cov)
+            pixels = band[rows, cols]
+            alpha = cov[rows, cols] if band.ndim == 2 else cov[rows, cols, None]
+            band[rows, cols] = np.floor(pixels + (color - pixels) * alpha + 0.5)
+
+    def split_lines(self, segs, max_length):
+        """Split the segments into pieces not longer than max_length; the union of the pieces
+           is the same as the segment, but much smaller boxes enclose them.
+        """
+        lengths = np.hypot(*(segs[:, 1] - segs[:, 0]).T)
+        counts = np.maximum(1, np.ceil(lengths / max_length)).astype(np.int64)
+        idx = np.repeat(np.arange(len(segs)), counts)
+        k = np.arange(len(idx)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        a, ab = segs[idx, 0], segs[idx, 1] - segs[idx, 0]
+        t0 = (k / counts[idx])[:, None]
+        t1 = ((k + 1) / counts[idx])[:, None]
+        return np.stack([a + ab * t0, a + ab * t1], axis=1)
+
+    def get_coverage(self, px, py, segs, reach):
+        """Return the anti-aliased coverage of the pixels (px, py) of shape (n, h, w)
+           by each of the n segments.
+        """
+        a = segs[:, 0, :, None, None]
+        ab = segs[:, 1, :, None, None] - segs[:, 0, :, None, None]
+        length2 = np.maximum(ab[:, 0] ** 2 + ab[:, 1] ** 2, 1e-12)
+
+        ax, ay = px - a[:, 0], py - a[:, 1]
+        t = np.clip((ax * ab[:, 0] + ay * ab[:, 1]) / length2, 0, 1)
+        dist = np.hypot(ax - t * ab[:, 0], ay - t * ab[:, 1])
+        return np.clip(reach - dist, 0, 1)
+
     @staticmethod
-    def output_image(coordinates, bg_color, line_color, line_thickness=5,
-                     height=256, width=256, gaussian_kernel=None,
-                     output_dir=None, with_suffix=True):
+    def create_image(coordinates, bg_color, line_color, line_thickness=5,
+                     height=256, width=256, gaussian_kernel=None, blur_method='exact',
+                     workers=None, scale=1, interpolation='bilinear'):
         generator = Lines(bg_color, height, width)
         img = generator.create_bg_image()
         generator.create_lines(img, coordinates, line_color, line_thickness)
 
         if gaussian_kernel is not None:
-            img = generator.blur(img, gaussian_kernel)
+            img = generator.blur_image(img, gaussian_kernel, blur_method, workers, scale, interpolation)
 
         # change rgb to bgr.
         img = generator.change_rgb_to_bgr(img)
+        return img
+
+    @staticmethod
+    def output_image(coordinates, bg_color, line_color, line_thickness=5,
+                     height=256, width=256, gaussian_kernel=None,
+                     output_dir=None, with_suffix=True, *, blur_method='exact',
+                     workers=None, scale=1, interpolation='bilinear'):
+        img = Lines.create_image(
+            coordinates, bg_color, line_color, line_thickness, height, width, gaussian_kernel,
+            blur_method, workers=workers, scale=scale, interpolation=interpolation)
         output_image(img, 'lines', output_dir, with_suffix)
 
 
@@ -59,20 +221,31 @@ class LineMask(Lines):
 
         self.line_color = (255, 255, 255) if white_lines else (0, 0, 0)
 
-    def create_lines(self, img, coordinates, thickness=5):
-        super().create_lines(img, coordinates, self.line_color, thickness)
+    def create_lines(self, img, coordinates, thickness=5, offset=0, method=None):
+        super().create_lines(img, coordinates, self.line_color, thickness, offset, method)
 
     @staticmethod
-    def output_image(coordinates, line_thickness=5, height=256, width=256,
-                     gaussian_kernel=31, white_lines=True,
-                     output_dir=None, with_suffix=True):
+    def create_image(coordinates, line_thickness=5, height=256, width=256,
+                     gaussian_kernel=31, white_lines=True, blur_method='exact', gray=False,
+                     workers=None, scale=1, interpolation='bilinear'):
         mask = LineMask(height, width, white_lines)
-        img = mask.create_bg_image()
+        img = mask.create_bg_image(gray=True)
         mask.create_lines(img, coordinates, line_thickness)
 
         if gaussian_kernel is not None:
-            img = mask.blur(img, gaussian_kernel)
+            img = mask.blur_image(img, gaussian_kernel, blur_method, workers, scale, interpolation)
 
+        # The mask is drawn and blurred in a single channel, which is expanded at last.
+        return img if gray else mask.expand(img)
+
+    @staticmethod
+    def output_image(coordinates, line_thickness=5, height=256, width=256,
+                     gaussian_kernel=31, white_lines=True,
+                     output_dir=None, with_suffix=True, *, blur_method='exact',
+                     workers=None, scale=1, interpolation='bilinear'):
+        img = LineMask.create_image(
+            coordinates, line_thickness, height, width, gaussian_kernel, white_lines,
+            blur_method, workers=workers, scale=scale, interpolation=interpolation)
         output_image(img, 'line_mask', output_dir, with_suffix)
 
 
@@ -86,6 +259,8 @@ class TransparentLineMask(Lines):
                 when False is specified, the background is white and the lines are black; default is True.
     """
 
+    transparent = True
+
     def __init__(self, height=256, width=256, white_lines=True):
         super().__init__(
             bg_color=(0, 0, 0, 255) if white_lines else (255, 255, 255, 255),
@@ -95,19 +270,33 @@ class TransparentLineMask(Lines):
 
         self.line_color = (255, 255, 255, 255) if white_lines else (0, 0, 0, 255)
 
-    def create_lines(self, img, coordinates, thickness=5):
-        super().create_lines(img, coordinates, self.line_color, thickness)
-        img[:, :, 3] -= img[:, :, 0]
+    def create_lines(self, img, coordinates, thickness=5, offset=0, method=None):
+        super().create_lines(img, coordinates, self.line_color, thickness, offset, method)
+
+        # The alpha channel of a single-channel image is derived by expand.
+        if img.ndim == 3:
+            self.make_transparent(img)
 
     @staticmethod
-    def output_image(coordinates, line_thickness=5, height=256, width=256,
-                     gaussian_kernel=31, white_lines=True,
-                     output_dir=None, with_suffix=True):
+    def create_image(coordinates, line_thickness=5, height=256, width=256,
+                     gaussian_kernel=31, white_lines=True, blur_method='exact', gray=False,
+                     workers=None, scale=1, interpolation='bilinear'):
         mask = TransparentLineMask(height, width, white_lines)
-        img = mask.create_bg_image()
+        img = mask.create_bg_image(gray=True)
         mask.create_lines(img, coordinates, line_thickness)
 
         if gaussian_kernel is not None:
-            img = mask.blur(img, gaussian_kernel)
+            img = mask.blur_image(img, gaussian_kernel, blur_method, workers, scale, interpolation)
+
+        # The mask is drawn and blurred in a single channel, which is expanded at last.
+        return img if gray else mask.expand(img)
 
+    @staticmethod
+    def output_image(coordinates, line_thickness=5, height=256, width=256,
+                     gaussian_kernel=31, white_lines=True,
+                     output_dir=None, with_suffix=True, *, blur_method='exact',
+                     workers=None, scale=1, interpolation='bilinear'):
+        img = TransparentLineMask.create_image(
+            coordinates, line_thickness, height, width, gaussian_kernel, white_lines,
+            blur_method, workers=workers, scale=scale, interpolation=interpolation)
         output_image(img, 'trans_line_mask', output_dir, with_suffix)
\ No newline at end of file
@@ -1,6 +1,126 @@
-import cv2
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+from . import backends
+from ..instrument import stage
+from ..lowres import INTERPOLATIONS
+from ..tiling import get_band_rows
+from ..utils import cv2, expand_mask
+
+
+# The rows drawn beyond a strip, which keep anti-aliased edges from being clipped.
+DRAW_MARGIN = 8
+
+BLUR_METHODS = ('exact', 'box', 'pyramid')
+
+# The variances in small pixels squared which INTER_AREA and the upsampling add to the blur of 'pyramid'.
+UPSAMPLE_VARIANCES = {'bilinear': 0.25, 'bicubic': 1 / 12}
+
+
+def gaussian_sigma(kernel):
+    """Return the sigma which cv2.GaussianBlur computes from the kernel size, if sigma is 0.
+    """
+    return 0.3 * ((kernel - 1) * 0.5 - 1) + 0.8
+
+
+def box_sizes(sigma, passes=3):
+    """Return the odd widths of the box filters whose repeated application approximates
+       the Gaussian of sigma (Kovesi, "Fast almost-Gaussian filtering").
+    """
+    ideal = (12 * sigma ** 2 / passes + 1) ** 0.5
+    lower = int(ideal) - (int(ideal) % 2 == 0)
+    m = round((12 * sigma ** 2 - passes * lower ** 2 - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    return [lower if i < m else lower + 2 for i in range(passes)]
+
+
+def blur_gaussian(img, kernel, backend='opencv'):
+    if backend == 'numpy':
+        return backends.gaussian_blur(img, kernel, gaussian_sigma(kernel))
+    return cv2.GaussianBlur(img, (kernel, kernel), 0)
+
+
+def blur_box(img, kernel, backend='opencv'):
+    sizes = box_sizes(gaussian_sigma(kernel))
+
+    if backend == 'numpy':
+        return backends.box_blur(img, sizes)
+
+    for size in sizes:
+        img = cv2.blur(img, (size, size), borderType=cv2.BORDER_REFLECT_101)
+    return img
+
+
+def blur_pyramid(img, kernel, backend='opencv', factor=None, interpolation='bilinear'):
+    sigma = gaussian_sigma(kernel)
+
+    if factor is None:
+        factor = 1
+        # Downsample while the Gaussian keeps 2 pixels of sigma.
+        while sigma / (factor * 2) >= 2:
+            factor *= 2
+
+    if factor == 1:
+        return blur_gaussian(img, kernel, backend)
+
+    # INTER_AREA averages factor x factor pixels, whose variance is 1 / 12 of a small pixel squared,
+    # and INTER_LINEAR adds 1 / 6; INTER_CUBIC adds almost nothing.
+    small_sigma = max((sigma / factor) ** 2 - UPSAMPLE_VARIANCES[interpolation], 0.01) ** 0.5
+
+    small_kernel = 2 * int(np.ceil(3 * small_sigma)) + 1
+    # The image is reflected around its edges like the full-resolution blur before downsampled,
+    # because the small image would be reflected around the centers of the small pixels;
+    # the margin is a multiple of factor, so that the samples are aligned with the image.
+    margin = factor * (small_kernel // 2 + 2)
+    height, width = img.shape[:2]
+
+    if backend == 'numpy':
+        if interpolation != 'bilinear':
+            raise ValueError('The bicubic interpolation needs OpenCV.')
+        padded = np.pad(img, margin, mode='reflect')
+        return backends.pyramid_blur(padded, factor, small_sigma)[margin:margin + height, margin:margin + width]
+
+    padded = cv2.copyMakeBorder(img, margin, margin, margin, margin, cv2.BORDER_REFLECT_101)
+    small = cv2.resize(padded, None, fx=1 / factor, fy=1 / factor, interpolation=cv2.INTER_AREA)
+    small = cv2.GaussianBlur(small, (small_kernel, small_kernel), small_sigma)
+    flag = cv2.INTER_LINEAR if interpolation == 'bilinear' else cv2.INTER_CUBIC
+    big = cv2.resize(small, None, fx=factor, fy=factor, interpolation=flag)
+    return np.ascontiguousarray(big[margin:margin + height, margin:margin + width])
+
+
+def get_blur_radius(kernel, method, backend='opencv'):
+    """Return the number of rows around a pixel on which the blurred pixel depends, so that bands of rows
+       padded with it are blurred into the same values as the whole image; None, if the result depends on
+       where a band starts: 'pyramid' resizes the image, and 'box' of the 'numpy' backend accumulates
+       the running sums in floating point.
+    """
+    if method == 'exact':
+        return kernel // 2
+    if method == 'box' and backend != 'numpy':
+        return sum(size // 2 for size in box_sizes(gaussian_sigma(kernel)))
+    return None
+
+
+def blur_bands(region, inner, blur_2d, radius, workers):
+    """Blur the inner rows of a region in bands on a thread pool; each band is blurred
+       with radius rows around it, which are clipped at the edges of the region like blurring it at once.
+    """
+    rows, cols = inner
+    out = np.empty((rows.stop - rows.start, cols.stop - cols.start), dtype=region.dtype)
+    band_rows = get_band_rows(out.shape[0], workers)
+
+    def fill(start):
+        stop = min(start + band_rows, rows.stop)
+        src_start = max(0, start - radius)
+        src_stop = min(region.shape[0], stop + radius)
+        blurred = blur_2d(np.ascontiguousarray(region[src_start:src_stop]))
+        out[start - rows.start:stop - rows.start] = blurred[start - src_start:stop - src_start, cols]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(fill, range(rows.start, rows.stop, band_rows)))
+
+    return out
+
 
 class ShapeMask:
     """A class to draw a shape on an image.
@@ -10,19 +130,204 @@ class ShapeMask:
             width (int): The width of an image; default is 256.
     """
 
+    # True for the classes whose drawn images are made transparent by make_transparent.
+    transparent = False
+
+    # 'opencv' or 'numpy', which draws and blurs shapes; if None, the one set by backends.set_backend.
+    backend = None
+
     def __init__(self, bg_color, height=256, width=256):
         self.height = height
         self.width = width
         self.bg_color = bg_color
 
-    def create_bg_image(self):
+    def get_backend(self):
+        return self.backend or backends.get_backend()
+
+    @stage('background')
+    def create_bg_image(self, gray=False):
+        """Return the background image. If gray is True, it has a single channel of the first value of bg_color,
+           on which black and white masks are drawn and blurred; expand turns it into the image of all channels.
+        """
+        if gray:
+            return np.full((self.height, self.width), self.bg_color[0], dtype=np.uint8)
+
         dim = (self.height, self.width, len(self.bg_color))
         img = np.full(dim, self.bg_color, dtype=np.uint8)
         return img
 
-    def blur(self, img, kernel):
-        return cv2.GaussianBlur(img, (kernel, kernel), 0)
+    def expand(self, mask, view=False):
+        """Expand a single-channel mask into the image of the channels of bg_color;
+           the alpha channel of transparent classes is derived from the mask at the same time.
+        """
+        return expand_mask(mask, len(self.bg_color), self.transparent, view)
+
+    def get_strip(self, start, stop, draw=None, kernel=None, gray=False):
+        """Return the rows from start to stop of the image. The rows above and below
+           the strip which the Gaussian blur reaches are drawn too, so that the strip
+           is the same as the one cut out of the whole image. The lines of Lines.create_lines
+           drawn by OpenCV are drawn on a canvas covering all of their rows, which OpenCV would
+           clip at the edges of the strip; method='sdf' keeps the memory within the strip.
+           The images of transparent classes are drawn in a single channel and expanded like create_image.
+            Args:
+                start (int): The first row of the strip.
+                stop (int): The row next to the last row of the strip.
+                draw (callable):
+                    Called with the image of the strip and the row offset of it,
+                    like draw(img, offset), to draw shapes on the image.
+                kernel (int): The Gaussian kernel size; if None, the image is not blurred.
+                gray (bool): If True, the strip has a single channel like create_bg_image(gray=True).
+        """
+        if self.transparent and not gray:
+            return self.expand(self.get_strip(start, stop, draw, kernel, gray=True))
+
+        halo = DRAW_MARGIN if kernel is None else DRAW_MARGIN + kernel // 2
+        top = max(0, start - halo)
+        bottom = min(self.height, stop + halo)
+
+        if gray:
+            img = np.full((bottom - top, self.width), self.bg_color[0], dtype=np.uint8)
+        else:
+            img = np.full((bottom - top, self.width, len(self.bg_color)), self.bg_color, dtype=np.uint8)
+
+        if draw is not None:
+            draw(img, top)
+
+        if kernel is not None:
+            img = self.blur(img, kernel)
+
+        return img[start - top:stop - top]
+
+    @stage('blur')
+    def blur(self, img, kernel, method='exact', bbox=None, workers=None, scale=None, interpolation='bilinear'):
+        """Blur an image with the Gaussian of the kernel size. Only the channels which vary are blurred,
+           and a channel which is the same as another one is copied from it.
+            Args:
+                img (numpy.ndarray): The image to be blurred.
+                kernel (int): The Gaussian kernel size.
+                method (str):
+                    'exact' uses cv2.GaussianBlur, or the separable Gaussian of the 'numpy' backend.
+                    'box' repeats box blur, computed by running sums, 3 times; the cost does not depend on kernel;
+                    the error against 'exact' was at most 5 and 0.12 on average in values from 0 to 255
+                    for circle and line masks with kernels from 31 to 101.
+                    'pyramid' downsamples the image, blurs it with the smaller Gaussian, and upsamples it;
+                    the error was at most 3 and 0.05 on average under the same conditions.
+                    Default is 'exact'.
+                bbox (tuple or str):
+                    (x0, y0, x1, y1) which encloses all of the shapes drawn on the background;
+                    only the area which the blur reaches from it is blurred, which gives the same result.
+                    If 'auto', it is found from the pixels different from the background.
+                workers (int):
+                    The number of threads blurring bands of rows, which give the same result as
+                    one thread; 'pyramid', and 'box' of the 'numpy' backend, are blurred on one thread.
+                scale (int):
+                    The factor by which 'pyramid' downsamples the image; if None, the largest power of 2
+                    which keeps 2 pixels of sigma. See lowres.choose_scale to find the one within an error.
+                interpolation (str): 'bilinear' or 'bicubic' by which 'pyramid' upsamples the image.
+        """
+        if method not in BLUR_METHODS:
+            raise ValueError(f'Unknown blur method: {method}; choose from {", ".join(BLUR_METHODS)}.')
+
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(f'Unknown interpolation: {interpolation}; choose from {", ".join(INTERPOLATIONS)}.')
+
+        backend = self.get_backend()
+        blur_2d = {
+            'exact': lambda arr: blur_gaussian(arr, kernel, backend),
+            'box': lambda arr: blur_box(arr, kernel, backend),
+            'pyramid': lambda arr: blur_pyramid(arr, kernel, backend, scale, interpolation)
+        }[method]
+
+        radius = get_blur_radius(kernel, method, backend) if workers and workers > 1 else None
+        height, width = img.shape[:2]
+        halo = kernel // 2
+
+        if bbox == 'auto':
+            bbox = self.find_bbox(img)
+            if bbox is None:
+                return img.copy()
 
+        if bbox is None:
+            src = dst = (slice(0, height), slice(0, width))
+        else:
+            x0, y0, x1, y1 = bbox
+            # The pixels within halo of the box are blurred from the pixels within 2 * halo.
+            src = (slice(max(0, y0 - 2 * halo), min(height, y1 + 2 * halo)),
+                   slice(max(0, x0 - 2 * halo), min(width, x1 + 2 * halo)))
+            dst = (slice(max(0, y0 - halo), min(height, y1 + halo)),
+                   slice(max(0, x0 - halo), min(width, x1 + halo)))
+
+        inner = tuple(slice(d.start - s.start, d.stop - s.start) for s, d in zip(src, dst))
+        channels = [img[..., c] for c in range(img.shape[2])] if img.ndim == 3 else [img]
+        out = img.copy()
+        out_channels = [out[..., c] for c in range(img.shape[2])] if img.ndim == 3 else [out]
+        blurred = []
+
+        for c, channel in enumerate(channels):
+            region = channel[src]
+
+            # A constant channel does not change.
+            if region.min() == region.max():
+                continue
+
+            for prev in blurred:
+                if np.array_equal(channels[prev][src], region):
+                    out_channels[c][dst] = out_channels[prev][dst]
+                    break
+            else:
+                if radius is not None:
+                    out_channels[c][dst] = blur_bands(region, inner, blur_2d, radius, workers)
+                else:
+                    out_channels[c][dst] = blur_2d(np.ascontiguousarray(region))[inner]
+                blurred.append(c)
+
+        return out
+
+    def blur_image(self, img, kernel, method='exact', workers=None, scale=1, interpolation='bilinear'):
+        """Blur the image which create_image draws. If scale is larger than 1, the blur is computed
+           at 1 / scale of the resolution by 'pyramid' and upsampled by interpolation instead of method.
+        """
+        if scale > 1:
+            return self.blur(img, kernel, 'pyramid', 'auto', scale=scale, interpolation=interpolation)
+        return self.blur(img, kernel, method, 'auto', workers)
+
+    def get_bg_pixel(self):
+        px = np.array(self.bg_color, dtype=np.uint8)
+
+        # The alpha of make_transparent, computed here so that no alpha stage is recorded for a pixel.
+        if self.transparent:
+            px[3] -= px[0]
+
+        return px
+
+    def find_bbox(self, img):
+        """Return (x0, y0, x1, y1) which encloses the pixels different from the background; None, if no pixels.
+        """
+        height, width = img.shape[:2]
+        channels = img.shape[2] if img.ndim == 3 else 1
+        flat = img.reshape(height, width * channels)
+        bg_row = np.tile(self.get_bg_pixel()[:channels], width)
+
+        # Compared in bands of rows, which stay in the cache; much faster than comparing the whole image at once.
+        changed = np.empty(height, dtype=bool)
+        for start in range(0, height, 64):
+            changed[start:start + 64] = (flat[start:start + 64] != bg_row).any(axis=1)
+
+        rows = np.flatnonzero(changed)
+        if not len(rows):
+            return None
+
+        diff = flat[rows[0]:rows[-1] + 1] != bg_row
+        cols = np.flatnonzero(diff.reshape(-1, width, channels).any(axis=(0, 2)))
+        return cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+
+    @stage('bgr')
     def change_rgb_to_bgr(self, img):
         img = img[:, :, ::-1]
-        return img
\ No newline at end of file
+        return img
+
+    @stage('alpha')
+    def make_transparent(self, img):
+        """Subtract the color from the alpha channel, so that white becomes transparent.
+        """
+        img[:, :, 3] -= img[:, :, 0]
\ No newline at end of file
@@ -0,0 +1,113 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# The number of bands per worker, which balances the load of the bands which differ in cost.
+BANDS_PER_WORKER = 4
+
+# The minimum number of rows of a band.
+MIN_BAND_ROWS = 16
+
+
+def iter_strips(height, tile_rows):
+    for start in range(0, height, tile_rows):
+        yield start, min(start + tile_rows, height)
+
+
+def get_band_rows(height, workers):
+    return max(MIN_BAND_ROWS, -(-height // (workers * BANDS_PER_WORKER)))
+
+
+def render(generator, workers=None, band_rows=None, out=None, **kwargs):
+    """Generate the whole image from the strips of a generator computed in bands of rows on a thread pool;
+       NumPy and OpenCV release the GIL while computing them. Every band is written into one preallocated array,
+       and the result is the same as get_strip(0, height) for any number of workers.
+        Args:
+            generator: An instance of a generator class, which has get_strip method.
+            workers (int): The number of threads; if None or 1, the image is generated at once on this thread.
+            band_rows (int): The number of rows of a band; if None, decided from height and workers.
+            out (numpy.ndarray):
+                The array into which get_strip writes the bands itself; the get_strip of the generator
+                must have out, like RadialGradient.get_strip. If None, a new array is created.
+            **kwargs: Passed to get_strip; for example, gray.
+    """
+    height = generator.height
+
+    if not workers or workers <= 1:
+        if out is not None:
+            kwargs['out'] = out
+        return generator.get_strip(0, height, **kwargs)
+
+    if band_rows is None:
+        band_rows = get_band_rows(height, workers)
+
+    bands = list(iter_strips(height, band_rows))
+
+    if out is None:
+        start, stop = bands.pop(0)
+        first = generator.get_strip(start, stop, **kwargs)
+        out = np.empty((height,) + first.shape[1:], dtype=first.dtype)
+        out[start:stop] = first
+
+        def fill(band):
+            out[band[0]:band[1]] = generator.get_strip(*band, **kwargs)
+    else:
+        def fill(band):
+            generator.get_strip(*band, out=out[band[0]:band[1]], **kwargs)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list raises the first error of the bands.
+        list(executor.map(fill, bands))
+
+    return out
+
+
+def output_tiled(generator, output_file=None, out=None, tile_rows=256, max_tiles=16, **kwargs):
+    """Generate an image strip by strip, so that the whole image is never held in memory.
+       The strips are the same as the rows of the image generated at once.
+        Args:
+            generator: An instance of a generator class, which has get_strip method.
+            output_file (str):
+                If the suffix is .npy, the strips are written into a numpy.memmap
+                saved in the .npy format; otherwise they are streamed into the file as raw bytes.
+            out (numpy.ndarray):
+                An array of shape (height, width, channels) like numpy.memmap, into which the strips are written.
+            tile_rows (int): The number of rows of a strip; default is 256.
+            max_tiles (int):
+                The number of strips written into a numpy.memmap before flushing it,
+                which limits the memory held by the written pages; default is 16.
+            **kwargs: Passed to get_strip; for example, draw and kernel of ShapeMask.get_strip.
+        Returns:
+            numpy.ndarray: out or the numpy.memmap opened from output_file; None, if streamed into a file.
+    """
+    if (output_file is None) == (out is None):
+        raise ValueError('Specify either output_file or out.')
+
+    strips = iter_strips(generator.height, tile_rows)
+    start, stop = next(strips)
+    strip = generator.get_strip(start, stop, **kwargs)
+
+    if out is None:
+        if not str(output_file).endswith('.npy'):
+            with open(output_file, 'wb') as f:
+                f.write(strip.tobytes())
+                for start, stop in strips:
+                    f.write(generator.get_strip(start, stop, **kwargs).tobytes())
+            return None
+
+        shape = (generator.height, generator.width) + strip.shape[2:]
+        out = np.lib.format.open_memmap(output_file, mode='w+', dtype=strip.dtype, shape=shape)
+
+    out[start:stop] = strip
+
+    for i, (start, stop) in enumerate(strips, 2):
+        out[start:stop] = generator.get_strip(start, stop, **kwargs)
+
+        if i % max_tiles == 0 and isinstance(out, np.memmap):
+            out.flush()
+
+    if isinstance(out, np.memmap):
+        out.flush()
+
+    return out
@@ -1,16 +1,277 @@
+import contextvars
+import importlib
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 
-import cv2
+import numpy as np
 
+from .instrument import stage
 
-def output_image(arr, stem, output_dir=None, with_suffix=True):
-    if with_suffix:
-        now = datetime.now()
-        stem = f'{stem}_{now.strftime("%Y%m%d%H%M%S")}'
 
-    output_file = f'{stem}.png'
+class LazyModule:
+    """A module which is imported when one of its attributes is used first.
+        Args:
+            name (str): The name of the module.
+    """
 
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    @property
+    def loaded(self):
+        return self._module is not None or self._name in sys.modules
+
+
+# OpenCV is imported only when drawing, blurring or writing needs it;
+# it takes much longer than the rest of this package to import.
+cv2 = LazyModule('cv2')
+
+
+def write_png(path, arr, compression=None):
+    params = [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, compression]
+    if not cv2.imwrite(path, arr, params):
+        raise OSError(f'Failed to write {path}.')
+
+
+def write_npy(path, arr):
+    np.save(path, arr)
+
+
+def write_tiff(path, arr):
+    # 1 means no compression.
+    if not cv2.imwrite(path, arr, [cv2.IMWRITE_TIFF_COMPRESSION, 1]):
+        raise OSError(f'Failed to write {path}.')
+
+
+def write_ppm(path, arr):
+    params = [] if path.endswith('.pam') else [cv2.IMWRITE_PXM_BINARY, 1]
+    if not cv2.imwrite(path, arr, params):
+        raise OSError(f'Failed to write {path}.')
+
+
+# The file extension and the function writing an array of each encoder.
+ENCODERS = {
+    'png': ('.png', write_png),
+    'npy': ('.npy', write_npy),
+    'tiff': ('.tiff', write_tiff),
+    'ppm': ('.ppm', write_ppm),
+}
+
+# The encoders which write only uint8 and uint16 images; OpenCV would convert floats into uint8 silently.
+INTEGER_ENCODERS = ('png', 'ppm')
+
+
+def get_extension(arr, encoder):
+    if encoder not in ENCODERS:
+        raise ValueError(f'Unknown encoder: {encoder}; choose from {", ".join(ENCODERS)}.')
+
+    if encoder in INTEGER_ENCODERS and arr.dtype.kind == 'f':
+        raise ValueError(f'The {encoder} encoder cannot write {arr.dtype} images; use npy or tiff.')
+
+    ext = ENCODERS[encoder][0]
+
+    # PPM has no alpha channel, so that images with 4 channels are written in PAM.
+    if encoder == 'ppm' and arr.ndim == 3 and arr.shape[2] == 4:
+        ext = '.pam'
+
+    return ext
+
+
+def make_path(stem, ext, output_dir=None, with_suffix=True):
+    """Return the output file path. With suffix, the path is reserved by creating an empty file
+       exclusively, so that writers running in parallel never get the same path.
+    """
     if output_dir is not None:
-        output_file = f'{output_dir}/{output_file}'
+        stem = f'{output_dir}/{stem}'
+
+    if not with_suffix:
+        return f'{stem}{ext}'
+
+    stem = f'{stem}_{datetime.now().strftime("%Y%m%d%H%M%S")}'
+    path = f'{stem}{ext}'
+
+    for i in range(1, 100000):
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except FileExistsError:
+            path = f'{stem}_{i}{ext}'
+
+    raise FileExistsError(f'No unique file name for {stem}{ext}.')
+
+
+# The value to which 1.0 of the gradient is scaled in each dtype of the images.
+DTYPE_MAX = {np.uint8: 255, np.uint16: 65535, np.float32: 1}
+
+
+def check_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.type not in DTYPE_MAX:
+        raise ValueError(f'Unsupported dtype: {dtype}; choose from uint8, uint16 and float32.')
+    return dtype
+
+
+def invert_mask(mask, out=None):
+    """Return 255 - mask for uint8, 65535 - mask for uint16 and 1 - mask for float masks.
+    """
+    if mask.dtype.kind == 'f':
+        return np.subtract(1, mask, out=out, dtype=mask.dtype)
+    return np.invert(mask, out=out)
+
+
+@stage('expand')
+def expand_mask(mask, channels=3, transparent=False, view=False, out=None):
+    """Expand a single-channel mask of shape (height, width) into an image of shape (height, width, channels).
+        Args:
+            mask (numpy.ndarray): The uint8, uint16 or float32 mask.
+            channels (int): The number of channels of the image; default is 3.
+            transparent (bool):
+                If True, the last channel is alpha, 255 - mask (65535 - mask for uint16, 1 - mask for floats),
+                so that white becomes transparent; it is derived while the channels are merged; default is False.
+            view (bool):
+                If True and not transparent, a read-only view which repeats the mask without copying it
+                is returned; the encoders copy it when writing; default is False.
+            out (numpy.ndarray):
+                The array of shape (height, width, channels) into which the channels are written;
+                the mask can be the first channel of it, which is not copied onto itself.
+    """
+    if out is not None:
+        first = 1 if mask.ctypes.data == out.ctypes.data and mask.strides == out.strides[:2] else 0
+        for i in range(first, channels - transparent):
+            out[:, :, i] = mask
+        if transparent:
+            invert_mask(mask, out=out[:, :, -1])
+        return out
+
+    if view and not transparent:
+        return np.broadcast_to(mask[:, :, np.newaxis], mask.shape + (channels,))
+
+    # cv2.merge is about 3 times faster than numpy.stack, but OpenCV is not imported only for it.
+    if cv2.loaded:
+        if transparent:
+            return cv2.merge([mask] * (channels - 1) + [invert_mask(mask)])
+        return cv2.merge([mask] * channels)
+
+    if transparent:
+        return np.stack([mask] * (channels - 1) + [invert_mask(mask)], axis=-1)
+    return np.stack([mask] * channels, axis=-1)
+
+
+@stage('write')
+def encode(path, arr, encoder='png', reserved=False, **settings):
+    """Write an array with an encoder. If reserved, the file was reserved by make_path,
+       and it is removed when the encoding fails, so that no empty or partial file is left.
+    """
+    try:
+        ENCODERS[encoder][1](path, arr, **settings)
+    except BaseException:
+        if reserved and os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+class ImageWriter:
+    """A class to write images on background threads, so that the generation of
+       the next image overlaps the encoding. While used as a context manager,
+       output_image passes images to it.
+        Args:
+            workers (int): The number of threads encoding images; default is 2.
+            max_pending (int):
+                The number of images waiting for being written; write blocks when it is reached;
+                if None, twice the number of workers.
+            encoder (str): 'png', 'npy', 'tiff' (uncompressed) or 'ppm'; default is 'png'.
+            **settings: Passed to the encoder; for example, compression from 0 to 9 of 'png'.
+    """
+
+    def __init__(self, workers=2, max_pending=None, encoder='png', **settings):
+        if encoder not in ENCODERS:
+            raise ValueError(f'Unknown encoder: {encoder}; choose from {", ".join(ENCODERS)}.')
+
+        self.encoder = encoder
+        self.settings = settings
+        self.errors = []
+
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending or workers * 2)
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._token = None
+
+    def __enter__(self):
+        self._token = _writer.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _writer.reset(self._token)
+        self.close()
+
+    def write(self, arr, stem, output_dir=None, with_suffix=True):
+        """Queue an image and return the path into which it will be written.
+           The array must not be modified until it is written.
+        """
+        path = make_path(stem, get_extension(arr, self.encoder), output_dir, with_suffix)
+        self._slots.acquire()
+
+        try:
+            future = self._executor.submit(encode, path, arr, self.encoder, with_suffix, **self.settings)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return path
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+            if (e := future.exception()) is not None:
+                self.errors.append(e)
+
+        self._slots.release()
+
+    def flush(self):
+        """Wait for all of the queued images to be written, and raise the first error if any.
+        """
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+        with self._lock:
+            errors, self.errors = self.errors, []
+
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+
+# The ImageWriter used as a context manager; a context variable, so that the images of other threads
+# are not passed to it.
+_writer = contextvars.ContextVar('writer', default=None)
+
+
+def output_image(arr, stem, output_dir=None, with_suffix=True, encoder='png', **settings):
+    """Write an image and return the path. If an ImageWriter is used as a context manager
+       in the same thread, the image is queued into it, and encoder and settings are ignored.
+    """
+    if (writer := _writer.get()) is not None:
+        return writer.write(arr, stem, output_dir, with_suffix)
 
-    cv2.imwrite(output_file, arr)
\ No newline at end of file
+    path = make_path(stem, get_extension(arr, encoder), output_dir, with_suffix)
+    encode(path, arr, encoder, with_suffix, **settings)
+    return path